@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+
+# Benchmarks for polytiles.py that run without Mapnik or a database
+
+import sys, os, time, argparse, random, shutil, tempfile, glob, json, resource, zlib
+import multiprocessing
+import polytiles
+
+# Rates reported by the benchmark that is running
+RESULTS = []
+
+
+def best_of(fn, repeat=3):
+	best = None
+	for i in range(repeat):
+		t = time.time()
+		fn()
+		dt = time.time() - t
+		best = dt if best is None else min(best, dt)
+	return best
+
+def report(name, count, unit, seconds):
+	print "{0:<32} {1:>12.0f} {2}/s".format(name, count / seconds, unit)
+	# A blank name continues the previous line
+	if not name and RESULTS:
+		name = RESULTS[-1]['name']
+	RESULTS.append({'name': name, 'count': count, 'unit': unit, 'seconds': seconds, 'rate': count / seconds})
+
+
+def bench_projection(options):
+	# Scalar vs. batched conversion of all tile edges of one zoom level
+	prj = polytiles.GoogleProjection()
+	z = options.zoom
+	px = [i * polytiles.TILE_SIZE for i in range(2**z + 1)]
+	ll = [prj.fromPixelToLL((p, p), z) for p in px]
+	lons = [l[0] for l in ll]
+	lats = [l[1] for l in ll]
+
+	report('fromPixelToLL', len(px), 'points', best_of(lambda: [prj.fromPixelToLL((p, p), z) for p in px]))
+	report('fromLLtoPixel', len(px), 'points', best_of(lambda: [prj.fromLLtoPixel(l, z) for l in ll]))
+	if polytiles.HAS_NUMPY:
+		report('fromPixelToLLArray', len(px), 'points', best_of(lambda: prj.fromPixelToLLArray(px, px, z)))
+		report('fromLLtoPixelArray', len(px), 'points', best_of(lambda: prj.fromLLtoPixelArray(lons, lats, z)))
+
+	def edges():
+		polytiles.GoogleProjection.edges.clear()
+		prj.tile_edges(z)
+	report('tile_edges', len(px), 'points', best_of(edges))
+
+
+class Blob:
+	# Stands in for a rendered image, already encoded
+	def __init__(self, data):
+		self.data = data
+
+	def tostring(self, format):
+		return self.data
+
+	def save(self, uri, format):
+		with open(uri, 'wb') as f:
+			f.write(self.data)
+
+def synthetic_tiles(count, seed=1):
+	# Tiles of 1-8 KB in column order, a third of them share one image
+	rnd = random.Random(seed)
+	blank = Blob(os.urandom(103))
+	side = int(count ** 0.5) + 1
+	tiles = []
+	for i in range(count):
+		image = blank if rnd.random() < 0.33 else Blob(os.urandom(rnd.randint(1024, 8192)))
+		tiles.append((i // side, i % side, 15, image))
+	return tiles
+
+def bench_mbtiles(options):
+	# Old (per tile, index up front, VACUUM) vs. batched MBTilesWriter
+	tiles = synthetic_tiles(options.count)
+	size = sum(len(t[3].data) for t in tiles)
+	modes = [
+		('MBTilesWriter', {}),
+		('MBTilesWriter batch=1000', {'batch': 1000}),
+		('MBTilesWriter batch=1000 wal', {'batch': 1000, 'wal': True}),
+		('MBTilesWriter dedup', {'dedup': True}),
+		('MBTilesWriter dedup batch=1000', {'dedup': True, 'batch': 1000}),
+	]
+	tmp = tempfile.mkdtemp()
+	try:
+		for name, params in modes:
+			def run():
+				filename = os.path.join(tmp, 'bench.mbtiles')
+				if os.path.exists(filename):
+					os.remove(filename)
+				writer = polytiles.MBTilesWriter(filename, 'bench', **params)
+				for i, t in enumerate(tiles):
+					writer.write(*t)
+					# Journaled like 8x8 metatiles of a render run
+					if i % 64 == 63:
+						writer.done(15, i, 0, 8)
+				writer.close()
+			seconds = best_of(run)
+			report(name, len(tiles), 'tiles', seconds)
+			report('', size / 1048576.0, 'MB', seconds)
+	finally:
+		shutil.rmtree(tmp)
+
+
+def bench_transport(options):
+	# Render processes handing tiles to the MBTiles writer process
+	tiles = synthetic_tiles(options.count)
+	size = sum(len(t[3].data) for t in tiles)
+	tmp = tempfile.mkdtemp()
+	try:
+		def run():
+			filename = os.path.join(tmp, 'bench.mbtiles')
+			if os.path.exists(filename):
+				os.remove(filename)
+			writer = polytiles.ThreadedWriterWrapper('MBTilesWriter', {'filename': filename, 'setname': 'bench', 'batch': 1000})
+			def produce(part):
+				for t in part:
+					writer.write(*t)
+			producers = [multiprocessing.Process(target=produce, args=(tiles[i::options.threads],)) for i in range(options.threads)]
+			for p in producers:
+				p.start()
+			for p in producers:
+				p.join()
+			writer.close()
+		seconds = best_of(run)
+		report('{0} processes'.format(options.threads), len(tiles), 'tiles', seconds)
+		report('', size / 1048576.0, 'MB', seconds)
+	finally:
+		shutil.rmtree(tmp)
+
+
+def bench_filewriter(options):
+	# FileWriter into a fresh tile directory
+	tiles = synthetic_tiles(options.count)
+	size = sum(len(t[3].data) for t in tiles)
+	tmp = tempfile.mkdtemp()
+	try:
+		def run():
+			tile_dir = os.path.join(tmp, 'tiles')
+			if os.path.exists(tile_dir):
+				shutil.rmtree(tile_dir)
+			writer = polytiles.FileWriter(tile_dir)
+			for i, t in enumerate(tiles):
+				writer.write(*t)
+				if i % 64 == 63:
+					writer.done(15, i, 0, 8)
+			writer.close()
+		seconds = best_of(run)
+		report('FileWriter', len(tiles), 'tiles', seconds)
+		report('', size / 1048576.0, 'MB', seconds)
+	finally:
+		shutil.rmtree(tmp)
+
+
+class StubImage:
+	# Stands in for a mapnik.Image: tiles are filled with a pattern that only
+	# depends on their position, every third one in a single color, and encode
+	# to 1-8 KB of incompressible data
+	def __init__(self, width, height, seed=0):
+		self.width = width
+		self.height = height
+		self.seed = seed
+
+	def view(self, x, y, width, height):
+		return StubImage(width, height, hash((self.seed, x, y)))
+
+	def tostring(self, format=None):
+		rnd = random.Random(self.seed)
+		if format is None:
+			if self.seed % 3 == 0:
+				return '\xb5\xd0\xd0\xff' * (self.width * self.height)
+			return ('%032x' % rnd.getrandbits(128)).decode('hex') * (self.width * self.height // 4)
+		size = rnd.randint(1024, 8192)
+		return ('%0*x' % (size * 2, rnd.getrandbits(size * 8))).decode('hex')
+
+class StubMap:
+	def __init__(self, width, height):
+		self.srs = '+init=epsg:3857'
+		self.box = None
+		self.buffer_size = 0
+
+	def resize(self, width, height):
+		pass
+
+	def zoom_to_box(self, box):
+		self.box = box
+
+class StubCoord:
+	def __init__(self, x, y):
+		self.x = x
+		self.y = y
+
+class StubProjection:
+	def __init__(self, srs):
+		pass
+
+	def forward(self, coord):
+		return coord
+
+class StubMapnik:
+	# Render backend with the parts of the mapnik module that polytiles uses;
+	# a render takes --render-time seconds and gives a deterministic image
+	render_time = 0.0
+	Map = StubMap
+	Coord = StubCoord
+	Projection = StubProjection
+	Image = StubImage
+
+	@staticmethod
+	def mapnik_version():
+		return 30000
+
+	@staticmethod
+	def load_map(m, mapfile, strict=False):
+		pass
+
+	@staticmethod
+	def Box2d(x0, y0, x1, y1):
+		return (round(x0, 9), round(y0, 9), round(x1, 9), round(y1, 9))
+
+	@staticmethod
+	def render(m, im, scale=1.0):
+		if StubMapnik.render_time:
+			time.sleep(StubMapnik.render_time)
+		im.seed = hash(m.box)
+
+def poly_files(options):
+	return sorted(glob.glob(options.polys))
+
+class CheckFailed(Exception):
+	pass
+
+def per_tile(generator, z):
+	# Covered tiles of a zoom level, every tile of the bounding box tested on
+	# its own against the polygon like PolyGenerator did before the row spans
+	prepared = polytiles.prep(generator.poly)
+	(xmin, xmax, ymin, ymax) = generator.tile_range(z)
+	tiles = set()
+	for x in range(xmin, xmax + 1):
+		for y in range(ymin, ymax + 1):
+			ll0 = generator.gprj.fromPixelToLL((x * polytiles.TILE_SIZE, (y + 1) * polytiles.TILE_SIZE), z)
+			ll1 = generator.gprj.fromPixelToLL(((x + 1) * polytiles.TILE_SIZE, y * polytiles.TILE_SIZE), z)
+			if prepared.intersects(polytiles.box(ll0[0], ll1[1], ll1[0], ll0[1])):
+				tiles.add((x, y))
+	return tiles
+
+def check_generators(options, names, polys):
+	# The row spans of PolyGenerator, exact and simplified, against the per
+	# tile test, on the poly files and on detailed outlines made from them
+	zooms = [options.area_zoom - 4, options.area_zoom - 2, options.area_zoom]
+	failed = 0
+	for name, poly in zip(names, polys):
+		for outline, kind in [(poly, ''), (poly.buffer(0.02, resolution=128), ' detailed')]:
+			expected = {}
+			for exact in (True, False):
+				# A single zoom level goes through coverage(), several through
+				# the quadtree
+				for levels in ([options.area_zoom], zooms):
+					generator = polytiles.PolyGenerator(outline, levels, exact=exact)
+					generator.gprj = polytiles.GoogleProjection(levels[-1] + 1)
+					for z, rows in generator.coverages():
+						if z not in expected:
+							expected[z] = per_tile(generator, z)
+						tiles = set((x, y) for y, spans in rows.items() for (a, b) in spans for x in range(a, b + 1))
+						if tiles != expected[z]:
+							failed += 1
+							print "{0}{1} z{2} {3}: {4} tiles missing, {5} extra".format(os.path.basename(name), kind, z, 'exact' if exact else 'simplified', len(expected[z] - tiles), len(tiles - expected[z]))
+	print "{0:<32} {1:>12} outlines".format('checked', 2 * len(polys))
+	if failed:
+		raise CheckFailed("{0} tile sets differ from the per tile test".format(failed))
+
+def bench_generators(options):
+	# PolyGenerator over all poly files, then ListGenerator reading the same
+	# tiles back from a text and a binary list
+	tasks = TaskList()
+	# Some of the bundled files are empty
+	parsed = [(f, polytiles.poly_parse(open(f))) for f in poly_files(options)]
+	parsed = [(f, p) for (f, p) in parsed if p]
+	polys = [p for (f, p) in parsed]
+	if options.check:
+		check_generators(options, [f for (f, p) in parsed], polys)
+	def run():
+		del tasks.tasks[:]
+		for poly in polys:
+			polytiles.PolyGenerator(poly, [options.area_zoom], metatile=8).generate(tasks)
+	seconds = best_of(run, 1)
+	tiles = sum(t.count() for t in tasks.tasks)
+	report('PolyGenerator {0} files'.format(len(polys)), tiles, 'tiles', seconds)
+
+	tmp = tempfile.mkdtemp()
+	try:
+		for name in ['tiles.lst', 'tiles.bin']:
+			filename = os.path.join(tmp, name)
+			writer = polytiles.list_writer(open(filename, 'w'))
+			for task in tasks.tasks:
+				for t in task.tiles():
+					writer.write(t[0], t[1], t[2])
+				writer.done(task.zoom, task.mtx0, task.mty0, task.metatile)
+			writer.close()
+			def read():
+				polytiles.ListGenerator(open(filename), metatile=8).generate(TaskList())
+			seconds = best_of(read, 1)
+			report('ListGenerator {0}'.format(name), tiles, 'tiles', seconds)
+			report('', os.path.getsize(filename) / 1048576.0, 'MB', seconds)
+	finally:
+		shutil.rmtree(tmp)
+
+def bench_pipeline(options):
+	# Metatiles of a poly file through the render queue, render processes with
+	# the stub backend and a FileWriter that drops empty tiles
+	polytiles.mapnik = StubMapnik
+	StubMapnik.render_time = options.render_time
+	poly = polytiles.poly_parse(open(options.poly))
+	tmp = tempfile.mkdtemp()
+	try:
+		writer = polytiles.FileWriter(os.path.join(tmp, 'tiles'), deleteempty=True)
+		tasks = TaskList()
+		polytiles.PolyGenerator(poly, [options.area_zoom], metatile=8).generate(tasks)
+		tiles = sum(t.count() for t in tasks.tasks)
+		start = time.time()
+		polytiles.render_tiles_multithreaded(polytiles.PolyGenerator(poly, [options.area_zoom], metatile=8), None, writer, num_threads=options.threads, verbose=False)
+		seconds = time.time() - start
+		size = 0
+		for root, dirs, files in os.walk(writer.tile_dir):
+			size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+		report('render queue, {0} processes'.format(options.threads), tiles, 'tiles', seconds)
+		report('', size / 1048576.0, 'MB', seconds)
+	finally:
+		shutil.rmtree(tmp)
+
+
+class TaskList:
+	# Collects what a generator puts into the render queue
+	def __init__(self):
+		self.tasks = []
+
+	def put(self, task):
+		self.tasks.append(task)
+
+class TaskReplay:
+	# Generator that puts collected tasks again
+	def __init__(self, tasks):
+		self.tasks = tasks
+
+	def generate(self, queue):
+		for t in self.tasks:
+			queue.put(t)
+
+def consume_tasks(queue):
+	# A render process that only takes the tasks apart
+	while True:
+		batch = queue.get()
+		if batch is None:
+			queue.task_done()
+			break
+		if isinstance(batch, list):
+			for packed in batch:
+				polytiles.unpack_task(packed)
+		queue.task_done()
+
+def bench_queue(options):
+	# Metatiles of a poly file through the render queue to processes that do
+	# not render: one RenderTask object per put from the main process, and
+	# packed tasks in batches from a producer process
+	poly = polytiles.poly_parse(open(options.poly))
+	tasks = TaskList()
+	polytiles.PolyGenerator(poly, [options.zoom], metatile=8).generate(tasks)
+	def through_queue(feed):
+		queue = multiprocessing.JoinableQueue(options.queue_depth)
+		consumers = [multiprocessing.Process(target=consume_tasks, args=(queue,)) for i in range(options.threads)]
+		for c in consumers:
+			c.start()
+		feed(queue)
+		for c in consumers:
+			queue.put(None)
+		queue.join()
+		for c in consumers:
+			c.join()
+	def objects(queue):
+		for t in tasks.tasks:
+			queue.put(t)
+	seconds = best_of(lambda: through_queue(objects))
+	report('RenderTask objects', len(tasks.tasks), 'tasks', seconds)
+	for batch in sorted(set([1, options.task_batch])):
+		def batches(queue):
+			producer = polytiles.TaskProducer(TaskReplay(tasks.tasks), queue, batch, verbose=False)
+			producer.start()
+			producer.wait()
+		seconds = best_of(lambda: through_queue(batches))
+		report('packed, batches of {0}'.format(batch), len(tasks.tasks), 'tasks', seconds)
+
+def cache_misses(tasks, page, capacity):
+	# Replays tasks against an LRU cache of page x page tile squares, standing
+	# in for the database buffer; a metatile reads its pages plus one tile of
+	# buffer around it
+	cache = {}
+	misses = 0
+	for i, t in enumerate(tasks):
+		x0 = (t.mtx0 - 1) // page
+		x1 = (t.mtx0 + t.metatile) // page
+		y0 = (t.mty0 - 1) // page
+		y1 = (t.mty0 + t.metatile) // page
+		for x in range(x0, x1 + 1):
+			for y in range(y0, y1 + 1):
+				if (t.zoom, x, y) not in cache:
+					misses += 1
+					if len(cache) >= capacity:
+						del cache[min(cache, key=cache.get)]
+				cache[(t.zoom, x, y)] = i
+	return misses
+
+def bench_order(options):
+	# Metatile orders: generation speed and page reads of a simulated cache
+	poly = polytiles.poly_parse(open(options.poly))
+	for order in ['column'] + sorted(polytiles.ORDERS):
+		generator = polytiles.PolyGenerator(poly, [options.zoom], metatile=8, order=order)
+		tasks = TaskList()
+		seconds = best_of(lambda: generator.generate(tasks), 1)
+		report('PolyGenerator {0}'.format(order), len(tasks.tasks), 'metatiles', seconds)
+		print "{0:<32} {1:>12} page reads".format('', cache_misses(tasks.tasks, options.page, options.cache))
+
+
+def bench_poly(options):
+	# Parsing, and tile coverage of a detailed outline like an area from the
+	# database against the full resolution and the simplified areas
+	seconds = best_of(lambda: polytiles.poly_parse(open(options.poly)))
+	poly = polytiles.poly_parse(open(options.poly))
+	report('poly_parse', polytiles.vertices(poly), 'vertices', seconds)
+	detailed = poly.buffer(0.02, resolution=128)
+	print "{0:<32} {1:>12} vertices".format('detailed outline', polytiles.vertices(detailed))
+	for zooms in [[options.zoom], [options.zoom - 4, options.zoom - 2, options.zoom]]:
+		for name, exact in [('exact', True), ('simplified', False)]:
+			def run():
+				generator = polytiles.PolyGenerator(detailed, zooms, exact=exact)
+				generator.gprj = polytiles.GoogleProjection(zooms[-1] + 1)
+				return sum([s[1] - s[0] + 1 for z, rows in generator.coverages() for spans in rows.values() for s in spans])
+			tiles = run()
+			report('coverage z{0} {1}'.format(','.join(map(str, zooms)), name), tiles, 'tiles', best_of(run))
+
+
+BENCHMARKS = {
+	'filewriter': bench_filewriter,
+	'generators': bench_generators,
+	'order': bench_order,
+	'pipeline': bench_pipeline,
+	'poly': bench_poly,
+	'projection': bench_projection,
+	'queue': bench_queue,
+	'mbtiles': bench_mbtiles,
+	'transport': bench_transport,
+}
+
+def run_isolated(name, options, results):
+	# Runs in a process of its own, so the peak RSS belongs to this benchmark
+	# and the processes it started
+	try:
+		BENCHMARKS[name](options)
+	except CheckFailed, e:
+		print e
+		results.put({'error': str(e)})
+		return
+	except Exception, e:
+		results.put({'error': repr(e)})
+		raise
+	rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+	results.put({'results': RESULTS, 'peak_rss_kb': rss})
+
+def compare(name, result, baseline):
+	# Relative change of each rate against a stored run
+	old = dict(((r['name'], r['unit']), r['rate']) for r in baseline.get(name, {}).get('results', []))
+	for r in result['results']:
+		if (r['name'], r['unit']) in old:
+			print "{0:<32} {1:>+11.1f}% {2}/s".format(r['name'], 100.0 * (r['rate'] / old[(r['name'], r['unit'])] - 1), r['unit'])
+	if 'peak_rss_kb' in baseline.get(name, {}):
+		print "{0:<32} {1:>+11.1f}% peak RSS".format('', 100.0 * (float(result['peak_rss_kb']) / baseline[name]['peak_rss_kb'] - 1))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmark parts of polytiles.py')
+	parser.add_argument('benchmarks', nargs='*', metavar='NAME', help='benchmarks to run: {0} (default: all)'.format(', '.join(sorted(BENCHMARKS))))
+	parser.add_argument('-z', '--zoom', type=int, default=15, help='zoom level (default: 15)')
+	parser.add_argument('-n', '--count', type=int, default=50000, help='number of synthetic tiles (default: 50000)')
+	parser.add_argument('--threads', type=int, default=4, help='number of processes (default: 4)')
+	parser.add_argument('-p', '--poly', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '../poly/north-america/us/massachusetts.poly'), help='poly file for the order, poly, pipeline and queue benchmarks (default: Massachusetts)')
+	parser.add_argument('--page', type=int, default=32, help='page size in tiles for the order benchmark (default: 32)')
+	parser.add_argument('--cache', type=int, default=64, help='pages in the simulated cache (default: 64)')
+	parser.add_argument('--polys', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '../poly/north-america/us/*.poly'), help='poly files for the generators benchmark (default: all US states)')
+	parser.add_argument('--area-zoom', type=int, default=13, help='zoom level for the generators and pipeline benchmarks (default: 13)')
+	parser.add_argument('--check', action='store_true', help='first compare the tiles of the generators benchmark with a per tile test of every poly file, exact and simplified, and fail on a difference')
+	parser.add_argument('--render-time', type=float, default=0.0, metavar='SEC', help='seconds a stub render takes in the pipeline benchmark (default: 0)')
+	parser.add_argument('--task-batch', type=int, default=polytiles.TASK_BATCH, metavar='N', help='metatiles per batch in the queue benchmark (default: {0})'.format(polytiles.TASK_BATCH))
+	parser.add_argument('--queue-depth', type=int, default=polytiles.TASK_QUEUE_DEPTH, metavar='N', help='length of the render queue in the queue benchmark (default: {0})'.format(polytiles.TASK_QUEUE_DEPTH))
+	parser.add_argument('--json', metavar='FILE', help='store the results as JSON')
+	parser.add_argument('--compare', metavar='FILE', help='compare the results with a run stored with --json')
+	options = parser.parse_args()
+
+	baseline = json.load(open(options.compare))['benchmarks'] if options.compare else None
+	results = {}
+	for name in options.benchmarks or sorted(BENCHMARKS):
+		if name not in BENCHMARKS:
+			print "Unknown benchmark: {0}".format(name)
+			sys.exit(1)
+		print "[{0}]".format(name)
+		queue = multiprocessing.Queue()
+		process = multiprocessing.Process(target=run_isolated, args=(name, options, queue))
+		process.start()
+		results[name] = queue.get()
+		process.join()
+		if 'error' in results[name]:
+			sys.exit(1)
+		print "{0:<32} {1:>12.1f} MB peak RSS".format('', results[name]['peak_rss_kb'] / 1024.0)
+		if baseline is not None:
+			compare(name, results[name], baseline)
+
+	if options.json:
+		with open(options.json, 'w') as f:
+			json.dump({'time': time.time(), 'options': vars(options), 'benchmarks': results}, f, indent=1, sort_keys=True)
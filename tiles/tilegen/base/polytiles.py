@@ -1,14 +1,26 @@
 #!/usr/bin/env python
 
-import mapnik
-import sys, os, getpass, argparse
-import multiprocessing
+import sys, os, getpass, argparse, hashlib, time, resource, socket, json, signal, heapq, tempfile, re, struct, itertools, random
+import multiprocessing, threading, Queue
 from math import pi,cos,sin,log,exp,atan
 from subprocess import call
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, Counter, deque
+from array import array
 from shapely.geometry import Polygon
+from shapely.prepared import prep
 from shapely.wkb import loads
+from shapely.ops import unary_union
+from shapely import wkt
 
 
+
+try:
+	import mapnik
+	HAS_MAPNIK = True
+except ImportError:
+	HAS_MAPNIK = False
+
 try:
 	import psycopg2
 	HAS_PSYCOPG = True
@@ -21,10 +33,80 @@ try:
 except ImportError:
 	HAS_SQLITE = False
 
+try:
+	import numpy
+	HAS_NUMPY = True
+except ImportError:
+	HAS_NUMPY = False
+
+try:
+	import ctypes
+	LIBC = ctypes.CDLL(None, use_errno=True)
+	LIBC.syncfs
+	HAS_SYNCFS = True
+except (ImportError, OSError, AttributeError):
+	HAS_SYNCFS = False
+
+try:
+	from shapely.ops import clip_by_rect
+except ImportError:
+	# Shapely before 1.7 only has the slower overlay
+	def clip_by_rect(geom, x1, y1, x2, y2):
+		return geom.intersection(box(x1, y1, x2, y2))
+
 DEG_TO_RAD = pi/180
 RAD_TO_DEG = 180/pi
 TILE_SIZE = 256
 LIST_QUEUE_LENGTH = 32
+# Tiles of a tile list that are grouped in memory, more are sorted on disk
+LIST_GROUP_TILES = 1000000
+# Binary tile lists: first line, extension, record type of bbox lines and
+# 8x8 tile cells a writer keeps before it writes them out
+LIST_MAGIC = "PTL1\n"
+LIST_BINARY_EXT = '.bin'
+LIST_BBOX = 0xff
+LIST_PENDING_CELLS = 4096
+# Tiles waiting for the encode/write threads of a render process
+WRITE_QUEUE_LENGTH = 128
+# Finished metatiles per fsync of the journal
+JOURNAL_BATCH = 32
+# Metatiles per batch on the render queue, and batches the generator process
+# keeps ahead of the render processes
+TASK_BATCH = 16
+TASK_QUEUE_DEPTH = 32
+# Writers of render service jobs a render process keeps, for the latest jobs
+SERVICE_WRITERS = 8
+# Layers of mazda.xml with rules that only apply beyond the scale of z11, so
+# they may have features in tiles that are blank at a lower zoom level
+DEEP_LAYERS = ['processed_p_outline', 'amenity-areas', 'agriculture', 'grass', 'park', 'forest', 'water-outline', 'wetland',
+	'aero-poly', 'parking-area', 'route-tunnels', 'route-line', 'route-turning-circles', 'route-fill', 'building',
+	'route-bridge-0', 'route-bridge-1', 'route-bridge-2', 'route-bridge-3', 'route-bridge-4', 'route-bridge-5',
+	'placenames-medium', 'highway-label']
+# File system block size for estimates of the space tiles take on disk
+BLOCK_SIZE = 4096
+# Tiles read per chunk by --optimize and tile results it keeps for
+# identical tiles
+OPTIMIZE_CHUNK = 256
+OPTIMIZE_CACHE = 4096
+# Lossless PNG optimizers for --optimize, the first one on the PATH is used
+PNG_OPTIMIZERS = [
+	('oxipng', ['-o', '2', '--strip', 'safe', '-q']),
+	('optipng', ['-o2', '-strip', 'all', '-quiet']),
+]
+# Stages of a metatile that are timed, metatile records per batch sent by a
+# render process and seconds between progress reports
+STAGES = ('bbox', 'render', 'slice', 'encode', 'write')
+METRICS_BATCH = 16
+PROGRESS_INTERVAL = 5
+# Tolerance (degrees) below which span ends are re-checked against the polygon
+SPAN_EPSILON = 1e-9
+# Simplification tolerance for the area of a zoom level, in tile widths, and
+# the number of polygon vertices from which simplifying pays off
+AREA_TOLERANCE = 1.0 / 64
+AREA_MIN_VERTICES = 1000
+# Renders at the current limit of --meta auto that have to stay within
+# --meta-memory before the next larger metatile size is allowed again
+SIZER_RECOVERY = 32
 
 
 def box(x1,y1,x2,y2):
@@ -35,6 +117,68 @@ def minmax (a,b,c):
 	a = min(a,c)
 	return a
 
+def vertices(geom):
+	# Number of coordinates of a polygon or of the polygons of a collection
+	if hasattr(geom, 'geoms'):
+		return sum([vertices(g) for g in geom.geoms])
+	if hasattr(geom, 'exterior'):
+		return len(geom.exterior.coords) + sum([len(r.coords) for r in geom.interiors])
+	return 0
+
+def merge_spans(spans):
+	# Joins overlapping and adjacent (xmin, xmax) column runs
+	result = []
+	for span in sorted(spans):
+		if result and span[0] <= result[-1][1] + 1:
+			result[-1] = (result[-1][0], max(result[-1][1], span[1]))
+		else:
+			result.append((span[0], span[1]))
+	return result
+
+def hilbert_key(z, x, y):
+	# Position of tile x, y on the Hilbert curve through all tiles of zoom z;
+	# tiles of an aligned metatile are always next to each other on the curve
+	n = 1 << z
+	d = 0
+	s = n >> 1
+	while s > 0:
+		rx = 1 if x & s else 0
+		ry = 1 if y & s else 0
+		d += s * s * ((3 * rx) ^ ry)
+		if ry == 0:
+			if rx == 1:
+				x = n - 1 - x
+				y = n - 1 - y
+			x, y = y, x
+		s >>= 1
+	return d
+
+def zorder_key(z, x, y):
+	# Interleaved bits of x and y (Morton order)
+	d = 0
+	bit = 0
+	while x or y:
+		d |= (x & 1) << bit | (y & 1) << (bit + 1)
+		x >>= 1
+		y >>= 1
+		bit += 2
+	return d
+
+# Orders for metatiles within a zoom level, besides column by column
+ORDERS = {'hilbert': hilbert_key, 'zorder': zorder_key}
+
+def uniform_color(raw):
+	# RGBA bytes of the only color in a raw image buffer, None if there are more
+	if raw[:4] * (len(raw) // 4) == raw:
+		return raw[:4]
+	return None
+
+def syncfs(fd):
+	# Flushes the whole file system that fd is on
+	if LIBC.syncfs(fd) != 0:
+		e = ctypes.get_errno()
+		raise OSError(e, os.strerror(e))
+
 def format2ext(format):
 	ext = 'png'
 	if format.startswith('jpeg'):
@@ -46,6 +190,8 @@ def format2ext(format):
 	return ext
 
 class GoogleProjection:
+	edges = {}
+
 	def __init__(self,levels=22):
 		self.Bc = []
 		self.Cc = []
@@ -74,6 +220,118 @@ class GoogleProjection:
 		 h = RAD_TO_DEG * ( 2 * atan(exp(g)) - 0.5 * pi)
 		 return (f,h)
 
+	# Array versions of the above, taking and returning numpy arrays
+	def fromLLtoPixelArray(self,lons,lats,zoom):
+		d = self.zc[zoom]
+		e = d[0] + numpy.asarray(lons, dtype=float) * self.Bc[zoom]
+		f = numpy.clip(numpy.sin(DEG_TO_RAD * numpy.asarray(lats, dtype=float)),-0.9999,0.9999)
+		g = d[1] + 0.5*numpy.log((1+f)/(1-f))*-self.Cc[zoom]
+		# round half away from zero, like round() does
+		return (numpy.sign(e) * numpy.floor(numpy.abs(e) + 0.5), numpy.sign(g) * numpy.floor(numpy.abs(g) + 0.5))
+
+	def fromPixelToLLArray(self,xs,ys,zoom):
+		e = self.zc[zoom]
+		f = (numpy.asarray(xs, dtype=float) - e[0])/self.Bc[zoom]
+		g = (numpy.asarray(ys, dtype=float) - e[1])/-self.Cc[zoom]
+		h = RAD_TO_DEG * ( 2 * numpy.arctan(numpy.exp(g)) - 0.5 * pi)
+		return (f,h)
+
+	def tile_edges(self,zoom):
+		# Longitudes of the left and latitudes of the top tile edges, 2**zoom + 1
+		# values each. Shared by all projections of the process.
+		if zoom not in GoogleProjection.edges:
+			px = [i * TILE_SIZE for i in range(2**zoom + 1)]
+			if HAS_NUMPY:
+				(lons, lats) = self.fromPixelToLLArray(px, px, zoom)
+				edges = (lons.tolist(), lats.tolist())
+			else:
+				ll = [self.fromPixelToLL((p, p), zoom) for p in px]
+				edges = ([l[0] for l in ll], [l[1] for l in ll])
+			GoogleProjection.edges[zoom] = edges
+		return GoogleProjection.edges[zoom]
+
+# Projects between tile pixel co-ordinates and LatLong (EPSG:4326) for all
+# render tasks
+TILE_PROJECTION = GoogleProjection()
+
+
+class TileBitmap:
+	# Set of tiles with one bit per tile of the bounding box of each zoom
+	def __init__(self):
+		self.zooms = {}
+
+	def add_zoom(self, z, xs, ys):
+		if not len(xs):
+			return
+		xmin = min(xs)
+		ymin = min(ys)
+		w = max(xs) - xmin + 1
+		h = max(ys) - ymin + 1
+		bits = bytearray((w * h + 7) // 8)
+		for i in range(len(xs)):
+			n = (ys[i] - ymin) * w + xs[i] - xmin
+			bits[n >> 3] |= 1 << (n & 7)
+		self.zooms[z] = (xmin, ymin, w, h, bits)
+
+	def __contains__(self, tile):
+		(x, y, z) = tile
+		if z not in self.zooms:
+			return False
+		(xmin, ymin, w, h, bits) = self.zooms[z]
+		x -= xmin
+		y -= ymin
+		if x < 0 or y < 0 or x >= w or y >= h:
+			return False
+		n = y * w + x
+		return bits[n >> 3] & (1 << (n & 7)) != 0
+
+	def __len__(self):
+		return sum([sum([bin(b).count('1') for b in z[4]]) for z in self.zooms.values()])
+
+
+def read_journal(filename):
+	# Finished metatiles as (zoom, x, y, metatile); a torn last line is ignored
+	finished = set()
+	if os.path.isfile(filename):
+		with open(filename) as f:
+			for line in f:
+				if line.endswith('\n'):
+					finished.add(tuple(int(v) for v in line.split()))
+	return finished
+
+class Journal:
+	# Append-only record of finished metatiles, synced to disk in batches.
+	# Forked render processes share the file and append whole batches.
+	def __init__(self, filename, resume=False):
+		self.filename = filename
+		self.finished = read_journal(filename) if resume else set()
+		self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if resume else os.O_TRUNC), 0o644)
+		self.pending = []
+		self.lock = threading.Lock()
+
+	def record(self, z, x, y, metatile):
+		# Returns True when a sync is due
+		with self.lock:
+			self.pending.append("{0} {1} {2} {3}\n".format(z, x, y, metatile))
+			return len(self.pending) >= JOURNAL_BATCH
+
+	def sync(self, before=None):
+		# before() puts the tiles of the pending metatiles on disk first
+		with self.lock:
+			pending = self.pending
+			self.pending = []
+		if pending:
+			if before:
+				before()
+			os.write(self.fd, ''.join(pending))
+			os.fsync(self.fd)
+
+	def close(self):
+		# Called after a complete run, the journal is not needed any more
+		self.sync()
+		os.close(self.fd)
+		os.remove(self.filename)
+
 
 class ListWriter:
 	def __init__(self, f):
@@ -91,17 +349,204 @@ class ListWriter:
 	def exists(self, x, y, z):
 		return False
 
+	def existing_tiles(self):
+		return None
+
+	def finished(self):
+		return set()
+
+	def done(self, z, x, y, metatile):
+		pass
+
+	def sync(self):
+		pass
+
 	def need_image(self):
 		return False
 
+	def skip_empty(self):
+		return False
+
 	def multithreading(self):
 		return False
 
 	def close(self):
 		self.f.close()
 
+def write_varint(out, n):
+	while n > 0x7f:
+		out.append(n & 0x7f | 0x80)
+		n >>= 7
+	out.append(n)
+
+def zigzag(n):
+	return n << 1 if n >= 0 else (-n << 1) - 1
+
+def unzigzag(n):
+	return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+class BinaryListWriter:
+	# Tile list as LIST_MAGIC followed by records of a zoom byte, the varint
+	# deltas of an 8x8 tile cell to the previous cell of that zoom and a 64 bit
+	# mask of the tiles in the cell. A zoom byte of LIST_BBOX starts a bbox line.
+	def __init__(self, f):
+		self.f = f
+		self.f.write(LIST_MAGIC)
+		# Cells of the current metatiles, {(z, cx, cy): mask}
+		self.cells = {}
+		self.last = {}
+
+	def __str__(self):
+		return "BinaryListWriter({0})".format(self.f.name)
+
+	def write_poly(self, poly):
+		text = "BBox: {0}".format(poly.bounds)
+		out = bytearray([LIST_BBOX])
+		write_varint(out, len(text))
+		self.f.write(out + text)
+
+	def write(self, x, y, z):
+		key = (z, x >> 3, y >> 3)
+		self.cells[key] = self.cells.get(key, 0) | 1 << ((y & 7) << 3 | x & 7)
+		if len(self.cells) >= LIST_PENDING_CELLS:
+			self.flush()
+
+	def flush(self):
+		out = bytearray()
+		for (z, cx, cy) in sorted(self.cells):
+			(px, py) = self.last.get(z, (0, 0))
+			out.append(z)
+			write_varint(out, zigzag(cx - px))
+			write_varint(out, zigzag(cy - py))
+			out.extend(struct.pack('<Q', self.cells[(z, cx, cy)]))
+			self.last[z] = (cx, cy)
+		self.f.write(out)
+		self.cells = {}
+
+	def exists(self, x, y, z):
+		return False
+
+	def existing_tiles(self):
+		return None
+
+	def finished(self):
+		return set()
+
+	def done(self, z, x, y, metatile):
+		self.flush()
+
+	def sync(self):
+		pass
+
+	def need_image(self):
+		return False
+
+	def skip_empty(self):
+		return False
+
+	def multithreading(self):
+		return False
+
+	def close(self):
+		self.flush()
+		self.f.close()
+
+def list_writer(f):
+	# Binary for files named *.bin, text otherwise
+	return BinaryListWriter(f) if f.name.endswith(LIST_BINARY_EXT) else ListWriter(f)
+
+def read_binary_list(f):
+	# Tiles (x, y, z) of a BinaryListWriter file after its LIST_MAGIC
+	last = {}
+	buf = bytearray()
+	pos = 0
+	eof = False
+	while True:
+		# A record is at most a zoom byte, two varints and the mask, bbox lines
+		# are shorter than 256 bytes
+		if not eof and len(buf) - pos < 256:
+			chunk = f.read(1 << 20)
+			eof = not chunk
+			buf = buf[pos:] + bytearray(chunk)
+			pos = 0
+		if pos >= len(buf):
+			return
+		z = buf[pos]
+		pos += 1
+		values = []
+		while len(values) < (1 if z == LIST_BBOX else 2):
+			n = 0
+			shift = 0
+			while True:
+				b = buf[pos]
+				pos += 1
+				n |= (b & 0x7f) << shift
+				shift += 7
+				if not b & 0x80:
+					break
+			values.append(n)
+		if z == LIST_BBOX:
+			pos += values[0]
+			continue
+		(px, py) = last.get(z, (0, 0))
+		cx = px + unzigzag(values[0])
+		cy = py + unzigzag(values[1])
+		last[z] = (cx, cy)
+		mask = struct.unpack_from('<Q', buffer(buf), pos)[0]
+		pos += 8
+		while mask:
+			low = mask & -mask
+			n = low.bit_length() - 1
+			yield ((cx << 3) | n & 7, (cy << 3) | n >> 3, z)
+			mask ^= low
+
+class SampleWriter:
+	# Encodes tiles without storing them and counts the file system blocks
+	# they would take, for --estimate
+	def __init__(self, format='png256'):
+		self.format = format
+		self.blocks = 0
+
+	def __str__(self):
+		return "SampleWriter({0})".format(self.format)
+
+	def write_poly(self, poly):
+		pass
+
+	def write(self, x, y, z, image):
+		data = image.tostring(self.format)
+		self.blocks += (len(data) + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+	def exists(self, x, y, z):
+		return False
+
+	def existing_tiles(self):
+		return None
+
+	def finished(self):
+		return set()
+
+	def done(self, z, x, y, metatile):
+		pass
+
+	def sync(self):
+		pass
+
+	def need_image(self):
+		return True
+
+	def skip_empty(self):
+		# Empty tiles are counted by the renderer
+		return True
+
+	def multithreading(self):
+		return False
+
+	def close(self):
+		pass
+
 class FileWriter:
-	def __init__(self, tile_dir, format='png256', tms=False, overwrite=True, deleteempty=True):
+	def __init__(self, tile_dir, format='png256', tms=False, overwrite=True, deleteempty=True, resume=False, journal=True):
 		self.format = format
 		self.overwrite = overwrite
 		self.tms = tms
@@ -111,6 +556,10 @@ class FileWriter:
 			self.tile_dir = self.tile_dir + '/'
 		if not os.path.isdir(self.tile_dir):
 			os.mkdir(self.tile_dir)
+		# The render service keeps the journal of its jobs itself
+		self.journal = Journal(self.tile_dir[:-1] + '.journal', resume) if journal else None
+		# Tiles and directories written since the last journal sync
+		self.unsynced = deque()
 
 	def __str__(self):
 		return "FileWriter({0})".format(self.tile_dir)
@@ -124,51 +573,137 @@ class FileWriter:
 	def exists(self, x, y, z):
 		return os.path.isfile(self.tile_uri(x, y, z))
 
+	def existing_tiles(self):
+		# All tiles in the directory, from a single walk over it
+		tiles = TileBitmap()
+		ext = '.' + format2ext(self.format)
+		for zdir in os.listdir(self.tile_dir):
+			if not zdir.isdigit():
+				continue
+			z = int(zdir)
+			xs = array('l')
+			ys = array('l')
+			for xdir in os.listdir(self.tile_dir + zdir):
+				if not xdir.isdigit():
+					continue
+				for name in os.listdir('{0}{1}/{2}'.format(self.tile_dir, zdir, xdir)):
+					if name.endswith(ext) and name[:-len(ext)].isdigit():
+						y = int(name[:-len(ext)])
+						xs.append(int(xdir))
+						ys.append(y if not self.tms else 2**z-1-y)
+			tiles.add_zoom(z, xs, ys)
+		return tiles
+
 	def write(self, x, y, z, image):
 		uri = self.tile_uri(x, y, z)
 		try:
 			os.makedirs(os.path.dirname(uri))
+			if self.journal:
+				self.unsynced.extend([os.path.dirname(os.path.dirname(uri)), self.tile_dir])
 		except OSError:
 			pass
 
-		if self.overwrite or not os.path.exists(uri):
+		if not self.overwrite and os.path.exists(uri):
+			return
+		if self.journal:
+			# A crash leaves the old tile or none, never half of a new one
+			tmp = '{0}.{1}.tmp'.format(uri, os.getpid())
+			image.save(tmp, self.format)
+			os.rename(tmp, uri)
+			self.unsynced.extend([uri, os.path.dirname(uri)])
+		else:
 			image.save(uri, self.format)
 
-		if self.deleteempty:
-			bytes=os.stat(uri)[6]
-			if bytes == 103:
-				os.remove(uri)
+	def sync_files(self):
+		paths = set()
+		while self.unsynced:
+			paths.add(self.unsynced.popleft())
+		if paths and HAS_SYNCFS:
+			# One call for the whole file system instead of one per tile
+			paths = [self.tile_dir]
+			sync = syncfs
+		else:
+			sync = os.fsync
+		for path in paths:
+			fd = os.open(path, os.O_RDONLY)
+			try:
+				sync(fd)
+			finally:
+				os.close(fd)
+
+	def finished(self):
+		return self.journal.finished if self.journal else set()
+
+	def done(self, z, x, y, metatile):
+		if self.journal and self.journal.record(z, x, y, metatile):
+			self.sync()
+
+	def sync(self):
+		# Tiles reach the disk before their metatiles get journaled
+		if self.journal:
+			self.journal.sync(self.sync_files)
 
 	def need_image(self):
 		return True
 
+	def skip_empty(self):
+		return self.deleteempty
+
 	def multithreading(self):
 		return True
 
 	def close(self):
-		pass
+		if self.journal:
+			self.sync_files()
+			self.journal.close()
 
 # https://github.com/mapbox/mbutil/blob/master/mbutil/util.py
 class MBTilesWriter:
-	def __init__(self, filename, setname, overlay=False, version=1, description=None, format='png256'):
+	def __init__(self, filename, setname, overlay=False, version=1, description=None, format='png256', deleteempty=False, dedup=False, batch=0, wal=False, resume=False):
 		self.format = format
+		self.deleteempty = deleteempty
 		self.filename = filename
 		if not self.filename.endswith('.mbtiles'):
 			self.filename = self.filename + '.mbtiles'
+		self.fresh = not os.path.exists(self.filename)
 		self.con = sqlite3.connect(self.filename)
 		self.cur = self.con.cursor()
 		self.cur.execute("""PRAGMA synchronous=0""")
 		self.cur.execute("""PRAGMA locking_mode=EXCLUSIVE""")
 		#self.cur.execute("""PRAGMA journal_mode=TRUNCATE""")
-		self.cur.execute("""create table if not exists tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);""")
+		if wal:
+			self.cur.execute("""PRAGMA journal_mode=WAL""")
+		# With a batch size tiles are buffered and committed every batch tiles
+		self.batch = batch
+		self.pending = []
+		# Tiles go into one explicit transaction from one commit to the next
+		self.con.isolation_level = None
+		self.transaction = False
+		# A new file gets its tile index after the bulk load
+		self.deferred_index = self.fresh and self.batch > 0
+		# An existing file keeps its layout
+		self.cur.execute("""select type from sqlite_master where name='tiles'""")
+		result = self.cur.fetchone()
+		self.dedup = result[0] == 'view' if result else dedup
+		self.tile_table = 'map' if self.dedup else 'tiles'
+		if self.dedup:
+			# Identical images are stored once, the tiles view keeps readers working
+			self.cur.execute("""create table if not exists map (zoom_level integer, tile_column integer, tile_row integer, tile_id text);""")
+			self.cur.execute("""create table if not exists images (tile_id text, tile_data blob);""")
+			self.cur.execute("""create unique index if not exists images_id on images (tile_id);""")
+			self.cur.execute("""create view if not exists tiles as select map.zoom_level as zoom_level, map.tile_column as tile_column, map.tile_row as tile_row, images.tile_data as tile_data from map join images on images.tile_id = map.tile_id;""")
+		else:
+			self.cur.execute("""create table if not exists tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob);""")
+		if not self.deferred_index:
+			self.create_tile_index()
 		self.cur.execute("""create table if not exists metadata (name text, value text);""")
 		self.cur.execute("""create unique index if not exists name on metadata (name);""")
-		self.cur.execute("""create unique index if not exists tile_index on tiles (zoom_level, tile_column, tile_row);""")
 		metadata = [ ('name', setname), ('format', format2ext(self.format)), ('type', 'overlay' if overlay else 'baselayer'), ('version', version) ]
 		if description:
 			metadata.append(('description', description))
 		for name, value in metadata:
 			self.cur.execute('insert or replace into metadata (name, value) values (?, ?)', (name, value))
+		self.journal = Journal(self.filename + '.journal', resume)
 
 	def __str__(self):
 		return "MBTilesWriter({0})".format(self.filename)
@@ -183,31 +718,113 @@ class MBTilesWriter:
 			bbox = bbox.union(oldbbox).bounds
 		self.cur.execute("""insert or replace into metadata (name, value) values ('bounds', ?)""", ','.join(bbox))
 
+	def create_tile_index(self):
+		index = 'map_index' if self.dedup else 'tile_index'
+		self.cur.execute("""create unique index if not exists {0} on {1} (zoom_level, tile_column, tile_row);""".format(index, self.tile_table))
+
 	def exists(self, x, y, z):
+		self.flush()
 		query = "select 1 from tiles where zoom_level = ? and tile_column = ? and tile_row = ?"
 		self.cur.execute(query, (z, x, 2**z-1-y))
 		return self.cur.fetchone()
 
+	def existing_tiles(self):
+		self.flush()
+		tiles = TileBitmap()
+		self.cur.execute("""select zoom_level, tile_column, tile_row from {0} order by zoom_level;""".format(self.tile_table))
+		z = None
+		for row in self.cur:
+			if row[0] != z:
+				if z is not None:
+					tiles.add_zoom(z, xs, ys)
+				z = row[0]
+				xs = array('l')
+				ys = array('l')
+			xs.append(row[1])
+			ys.append(2**z-1-row[2])
+		if z is not None:
+			tiles.add_zoom(z, xs, ys)
+		return tiles
+
+	def insert(self, rows):
+		# rows are (zoom_level, tile_column, tile_row, tile_id, tile_data)
+		if not self.transaction:
+			self.cur.execute("""BEGIN""")
+			self.transaction = True
+		if self.dedup:
+			self.cur.executemany("insert or ignore into images (tile_id, tile_data) values (?, ?);", [(r[3], r[4]) for r in rows])
+			self.cur.executemany("insert or replace into map (zoom_level, tile_column, tile_row, tile_id) values (?, ?, ?, ?);", [r[:4] for r in rows])
+		else:
+			query = "insert or replace into tiles (zoom_level, tile_column, tile_row, tile_data) values (?, ?, ?, ?);"
+			self.cur.executemany(query, [(r[0], r[1], r[2], r[4]) for r in rows])
+
+	def flush(self):
+		if self.pending:
+			self.insert(self.pending)
+			self.pending = []
+
+	def commit(self):
+		self.flush()
+		if self.transaction:
+			self.cur.execute("""COMMIT""")
+			self.transaction = False
+
 	def write(self, x, y, z, image):
-		query = "insert or replace into tiles (zoom_level, tile_column, tile_row, tile_data) values (?, ?, ?, ?);"
-		self.cur.execute(query, (z, x, 2**z-1-y, sqlite3.Binary(image.tostring(self.format))))
+		data = image.tostring(self.format)
+		row = (z, x, 2**z-1-y, hashlib.md5(data).hexdigest() if self.dedup else None, sqlite3.Binary(data))
+		if self.batch > 0:
+			self.pending.append(row)
+			if len(self.pending) >= self.batch:
+				self.sync()
+		else:
+			self.insert([row])
+
+	def finished(self):
+		return self.journal.finished
+
+	def done(self, z, x, y, metatile):
+		if self.journal.record(z, x, y, metatile):
+			self.sync()
+
+	def sync(self):
+		# Tiles are committed before their metatiles are journaled
+		self.commit()
+		self.journal.sync()
 
 	def need_image(self):
 		return True
 
+	def skip_empty(self):
+		return self.deleteempty
+
 	def multithreading(self):
 		return False
 
 	def close(self):
+		self.commit()
+		if self.deferred_index:
+			try:
+				self.create_tile_index()
+			except sqlite3.IntegrityError:
+				# Keep the last version of tiles that were written more than once
+				self.cur.execute("""delete from {0} where rowid not in (select max(rowid) from {0} group by zoom_level, tile_column, tile_row);""".format(self.tile_table))
+				self.create_tile_index()
 		self.cur.execute("""ANALYZE;""")
-		self.cur.execute("""VACUUM;""")
+		# A new file has hardly any free pages, rewriting it would gain nothing
+		self.cur.execute("""PRAGMA freelist_count""")
+		free = self.cur.fetchone()[0]
+		self.cur.execute("""PRAGMA page_count""")
+		pages = self.cur.fetchone()[0]
+		if not self.fresh or free * 10 > pages:
+			self.cur.execute("""VACUUM;""")
 		self.cur.close()
 		self.con.close()
+		self.journal.close()
 
 
 class FakeImage:
-	def __init__(self, image, format):
-		self.imgstr = image.tostring(format)
+	def __init__(self, imgstr):
+		self.imgstr = imgstr
 
 	def tostring(self, format):
 		return self.imgstr
@@ -223,9 +840,11 @@ class ThreadedWriterWrapper(multiprocessing.Process):
 		self.wparams = wparams
 		self.format = wparams['format'] if 'format' in wparams else 'png256'
 		(self.p_pipe, self.pipe) = multiprocessing.Pipe()
+		# All render processes send through the same end of the pipe
+		self.lock = multiprocessing.Lock()
 		self.daemon = True
 		self.start()
-		(self.ni, self.desc) = self.p_pipe.recv()
+		(self.ni, self.se, self.desc) = self.p_pipe.recv()
 
 	def __str__(self):
 		return "Threaded{0}".format(self.desc)
@@ -236,75 +855,139 @@ class ThreadedWriterWrapper(multiprocessing.Process):
 			return
 		writer = writerConstr(**self.wparams)
 		need_image = writer.need_image()
-		self.pipe.send((need_image, str(writer)))
+		self.pipe.send((need_image, writer.skip_empty(), str(writer)))
 		while True:
 			req, args = self.pipe.recv()
 			if req == 'close':
 				break
 			if req == 'write_poly':
 				writer.write_poly(args)
+			if req == 'existing_tiles':
+				self.pipe.send(writer.existing_tiles())
+			if req == 'finished':
+				self.pipe.send(writer.finished())
+			if req == 'done':
+				writer.done(*args)
 			if req == 'write':
 				if need_image:
-					writer.write(args[0], args[1], args[2], args[3])
+					writer.write(args[0], args[1], args[2], FakeImage(args[3]))
 				else:
 					writer.write(args[0], args[1], args[2])
 		writer.close()
 
 	def write_poly(self, poly):
-		self.p_pipe.send(('write_poly', poly))
+		self.send('write_poly', poly)
 
 	def exists(self, x, y, z):
 		return False
 
+	def send(self, req, args):
+		with self.lock:
+			self.p_pipe.send((req, args))
+
+	def ask(self, req):
+		with self.lock:
+			self.p_pipe.send((req, None))
+			return self.p_pipe.recv()
+
+	def existing_tiles(self):
+		return self.ask('existing_tiles')
+
+	def finished(self):
+		return self.ask('finished')
+
+	def done(self, z, x, y, metatile):
+		self.send('done', (z, x, y, metatile))
+
+	def sync(self):
+		pass
+
 	def write(self, x, y, z, image):
-		self.p_pipe.send(('write', (x, y, z, FakeImage(image, self.format))))
+		self.send('write', (x, y, z, image.tostring(self.format)))
 
 	def need_image(self):
 		return self.ni
 
+	def skip_empty(self):
+		return self.se
+
 	def multithreading(self):
 		return True
 
 	def close(self):
-		self.p_pipe.send(('close', None))
+		self.send('close', None)
 		self.join()
 
-def multi_MBTilesWriter(threads, filename, setname, overlay=False, version=1, description=None, format='png256'):
-	params = {'filename': filename, 'setname': setname, 'overlay': overlay, 'version': version, 'description': description, 'format': format}
+def multi_MBTilesWriter(threads, filename, setname, overlay=False, version=1, description=None, format='png256', deleteempty=False, dedup=False, batch=0, wal=False, resume=False):
+	params = {'filename': filename, 'setname': setname, 'overlay': overlay, 'version': version, 'description': description, 'format': format, 'deleteempty': deleteempty, 'dedup': dedup, 'batch': batch, 'wal': wal, 'resume': resume}
 	if threads == 1:
 		return MBTilesWriter(**params)
 	else:
 		return ThreadedWriterWrapper('MBTilesWriter', params)
 
-class RenderTask:
+class RenderTask(object):
+	# Millions of these exist in a large run, so they keep their tiles in one
+	# bit mask, row by row from the top left tile (64 bits for 8x8 metatiles),
+	# and share the projection
+	__slots__ = ('zoom', 'metatile', 'mtx0', 'mty0', 'mask', 'job', 'fill', 'prj')
+
 	def __init__(self, metatile, zoom, x, y):
 		self.zoom = zoom
 		self.metatile = metatile
 		self.mtx0 = x - x % metatile
 		self.mty0 = y - y % metatile
-		self._tiles = set()
-		# Projects between tile pixel co-ordinates and LatLong (EPSG:4326)
-		self.tileproj = GoogleProjection()
+		self.mask = 0
+		# (id, FileWriter parameters) of a render service job
+		self.job = None
+		# RGBA bytes of the color of a task that is filled instead of rendered
+		self.fill = None
+		# Map projection, set by the render process
+		self.prj = None
+
+	def __reduce__(self):
+		# Pickled as its packed tuple, without the map projection
+		return (unpack_task, (self.pack(),))
+
+	def bit(self, x, y):
+		return 1 << ((y - self.mty0) * self.metatile + x - self.mtx0)
 
 	def add(self, x, y):
 		if self.belongs(x, y):
-			self._tiles.add((x, y))
+			self.mask |= self.bit(x, y)
+
+	def discard(self, x, y):
+		if self.belongs(x, y):
+			self.mask &= ~self.bit(x, y)
+
+	def empty(self):
+		return not self.mask
+
+	def count(self):
+		return bin(self.mask).count('1')
 
 	def belongs(self, x, y, z = -1):
 		return (z < 0 or z == self.zoom) and x >= self.mtx0 and y >= self.mty0 and x < self.mtx0 + self.metatile and y < self.mty0 + self.metatile
 
 	def tiles(self):
-		for t in self._tiles:
-			yield (t[0], t[1], self.zoom, t[0] - self.mtx0, t[1] - self.mty0)
-
-	def get_bbox(self):
-		# Calculate pixel positions of bottom-left & top-right
-		p0 = (self.mtx0 * TILE_SIZE, (self.mty0 + self.metatile) * TILE_SIZE)
-		p1 = ((self.mtx0 + self.metatile) * TILE_SIZE, self.mty0 * TILE_SIZE)
+		# Lowest bit first, bin() puts it last
+		for i, bit in enumerate(reversed(bin(self.mask))):
+			if bit == '1':
+				dx = i % self.metatile
+				dy = i // self.metatile
+				yield (self.mtx0 + dx, self.mty0 + dy, self.zoom, dx, dy)
+
+	def pack(self):
+		# Compact tuple for the render queue
+		return (self.metatile, self.zoom, self.mtx0, self.mty0, self.mask, self.job, self.fill)
+
+	def get_bbox(self, buffer=0):
+		# Calculate pixel positions of bottom-left & top-right, grown by buffer pixels
+		p0 = (self.mtx0 * TILE_SIZE - buffer, (self.mty0 + self.metatile) * TILE_SIZE + buffer)
+		p1 = ((self.mtx0 + self.metatile) * TILE_SIZE + buffer, self.mty0 * TILE_SIZE - buffer)
 
 		# Convert to LatLong (EPSG:4326)
-		l0 = self.tileproj.fromPixelToLL(p0, self.zoom);
-		l1 = self.tileproj.fromPixelToLL(p1, self.zoom);
+		l0 = TILE_PROJECTION.fromPixelToLL(p0, self.zoom);
+		l1 = TILE_PROJECTION.fromPixelToLL(p1, self.zoom);
 
 		# Convert to map projection (e.g. mercator co-ords EPSG:900913)
 		c0 = self.prj.forward(mapnik.Coord(l0[0],l0[1]))
@@ -317,168 +1000,1481 @@ class RenderTask:
 			bbox = mapnik.Envelope(c0.x,c0.y, c1.x,c1.y)
 		return bbox
 
+def unpack_task(packed):
+	(metatile, zoom, x0, y0, mask, job, fill) = packed
+	task = RenderTask(metatile, zoom, x0, y0)
+	task.mask = mask
+	task.job = job
+	task.fill = fill
+	return task
+
+class TaskBatcher:
+	# Stands between a generator and the render queue and puts its metatiles
+	# on the queue as packed tuples, in batches. The number of metatiles and
+	# tiles of every batch goes to RunMetrics over its record queue.
+	def __init__(self, queue, size=TASK_BATCH, records=None):
+		self.queue = queue
+		self.size = size
+		self.records = records
+		self.batch = []
+		self.tiles = 0
+
+	def put(self, task):
+		self.batch.append(task.pack())
+		self.tiles += task.count()
+		if len(self.batch) >= self.size:
+			self.flush()
+
+	def flush(self):
+		if self.batch:
+			self.queue.put(self.batch)
+			if self.records is not None:
+				self.records.put(('queued', len(self.batch), self.tiles))
+			self.batch = []
+			self.tiles = 0
+
+class BlankFilter:
+	# Stands between a generator and the render queue for --skip-blank. Render
+	# processes report the tiles of every metatile that came out in a single
+	# color without features of the deep layers. A metatile whose tiles all lie
+	# in such tiles of the zoom level above, all of one color, is filled with
+	# that color instead of rendered, and its tiles count as blank for the next
+	# level. Zoom levels have to come one after another from the top, and the
+	# first metatile of a level waits until the level above is reported.
+	def __init__(self, queue, reports, blank_zooms=None):
+		self.queue = queue
+		self.reports = reports
+		self.blank_zooms = blank_zooms
+		# {zoom: {(x, y): color}}
+		self.blank = {}
+		# Metatiles per zoom that were queued for rendering and reported back
+		self.expected = {}
+		self.received = {}
+		self.zoom = None
+		self.parent = None
+		self.filled = 0
+		self.filled_tiles = 0
+
+	def summary(self):
+		return "Filled {0} metatiles with {1} tiles under blank tiles instead of rendering them".format(self.filled, self.filled_tiles)
+
+	def receive(self, report):
+		(zoom, blanks) = report
+		self.received[zoom] = self.received.get(zoom, 0) + 1
+		if blanks:
+			tiles = self.blank.setdefault(zoom, {})
+			for (x, y, color) in blanks:
+				tiles[(x, y)] = color
+
+	def wait(self):
+		# Until every queued metatile is reported, the last ones may still
+		# wait in a batch
+		self.queue.flush()
+		for z in self.expected:
+			while self.received.get(z, 0) < self.expected[z]:
+				self.receive(self.reports.get())
+
+	def color(self, task):
+		# Color of the blank parents of all tiles of a task, None unless they
+		# are all blank in the same color
+		tiles = self.blank.get(self.parent)
+		if not tiles:
+			return None
+		d = task.zoom - self.parent
+		color = None
+		for t in task.tiles():
+			c = tiles.get((t[0] >> d, t[1] >> d))
+			if c is None or (color is not None and c != color):
+				return None
+			color = c
+		return color
+
+	def put(self, task):
+		if task.zoom != self.zoom:
+			self.wait()
+			# Lower zoom levels than before get no parent
+			self.parent = self.zoom if self.zoom is not None and self.zoom < task.zoom else None
+			self.zoom = task.zoom
+			self.blank = dict([(z, tiles) for z, tiles in self.blank.items() if z == self.parent])
+		else:
+			while True:
+				try:
+					self.receive(self.reports.get_nowait())
+				except Queue.Empty:
+					break
+		reported = self.blank_zooms is None or task.zoom in self.blank_zooms
+		color = self.color(task)
+		if color is not None:
+			task.fill = color
+			self.filled += 1
+			self.filled_tiles += task.count()
+			if reported:
+				tiles = self.blank.setdefault(task.zoom, {})
+				for t in task.tiles():
+					tiles[(t[0], t[1])] = color
+		elif reported:
+			self.expected[task.zoom] = self.expected.get(task.zoom, 0) + 1
+		self.queue.put(task)
+
+class MetatileMetrics:
+	# Timings and counts of one metatile; the write threads of a render process
+	# fill them in while the next metatile renders
+	def __init__(self, task, worker):
+		self.record = {'worker': worker, 'zoom': task.zoom, 'x': task.mtx0, 'y': task.mty0, 'metatile': task.metatile, 'tiles': task.count(), 'empty': 0, 'bytes': 0}
+		for stage in STAGES:
+			self.record[stage] = 0.0
+		self.left = task.count()
+
 class RenderThread:
-	def __init__(self, writer, mapfile, q, printLock, verbose=True, scale=1.0, renderlist=False):
+	def __init__(self, writer, mapfile, q, scale=1.0, renderlist=False, io_threads=0, feedback=None, results=None, metrics=None, worker=0, blanks=None, blank_zooms=None, deep_layers=None):
+		# None for the render service, its tasks bring their own output
 		self.writer = writer
 		self.q = q
+		# Render time and peak memory of every metatile go back to the generator
+		self.feedback = feedback
+		# Blank tiles of metatiles of these zoom levels (all when None) go back
+		# to the generator, unless the deep layers have features in them
+		self.blanks = blanks
+		self.blank_zooms = blank_zooms
+		self.deep_layers = deep_layers or []
+		self.deep = []
+		# Encoded fill tiles per color and format
+		self.fills = {}
+		# Finished metatiles of render service jobs go back to the service
+		self.results = results
+		# Records of finished metatiles go to RunMetrics in batches
+		self.metrics = metrics
+		self.worker = worker
+		self.pending = []
+		self.sent = time.time()
+		self.writers = OrderedDict()
+		self.writers_lock = threading.Lock()
 		self.mapfile = mapfile
-		self.printLock = printLock
-		self.verbose = verbose
 		self.renderlist = renderlist
 		self.scale = scale
 		self.scaled_size = int(TILE_SIZE * scale)
+		# Threads that encode and write tiles while the next metatile renders;
+		# only for writers that may be used from several processes at once
+		self.io_threads = io_threads if not writer or writer.multithreading() else 0
+		self.lock = threading.Lock()
+
+	def add_time(self, m, stage, start):
+		with self.lock:
+			m.record[stage] += time.time() - start
+
+	def writer_for(self, task):
+		if task.job is None:
+			return self.writer
+		(job, params) = task.job
+		with self.writers_lock:
+			# The render process does not learn when a job ends, writers of
+			# jobs that have not been seen for a while are let go
+			writer = self.writers.pop(job, None) or FileWriter(journal=False, **params)
+			self.writers[job] = writer
+			while len(self.writers) > SERVICE_WRITERS:
+				self.writers.popitem(last=False)[1].close()
+		return writer
+
+	def report(self, m):
+		# Called with self.lock held
+		if self.metrics is None:
+			return
+		m.record['time'] = time.time()
+		self.pending.append(m.record)
+		if len(self.pending) >= METRICS_BATCH or m.record['time'] - self.sent >= PROGRESS_INTERVAL:
+			self.send_metrics()
+
+	def send_metrics(self):
+		if self.pending:
+			self.metrics.put(self.pending)
+			self.pending = []
+		self.sent = time.time()
+
+	def finish(self, task, m):
+		# Called without self.lock, the writer may sync its files here
+		self.writer_for(task).done(task.zoom, task.mtx0, task.mty0, task.metatile)
+		if task.job is not None:
+			self.results.put((task.job[0], task.zoom, task.mtx0, task.mty0, task.metatile, task.count()))
+		with self.lock:
+			self.report(m)
+
+	def write_tile(self, im, t, task, m):
+		# Cuts one tile out of the metatile image and hands it to the writer
+		start = time.time()
+		writer = self.writer_for(task)
+		view = im if task.metatile == 1 else im.view(t[3] * self.scaled_size, t[4] * self.scaled_size, self.scaled_size, self.scaled_size)
+		# Drop blank tiles before they get encoded
+		empty = writer.skip_empty() and uniform_color(view.tostring()) is not None
+		self.add_time(m, 'slice', start)
+		if empty:
+			with self.lock:
+				m.record['empty'] += 1
+		else:
+			start = time.time()
+			data = view.tostring(writer.format)
+			self.add_time(m, 'encode', start)
+			start = time.time()
+			writer.write(t[0], t[1], t[2], FakeImage(data))
+			self.add_time(m, 'write', start)
+			with self.lock:
+				m.record['bytes'] += len(data)
+
+		# The last tile of a metatile marks it as done
+		with self.lock:
+			m.left -= 1
+			last = m.left == 0
+		if last:
+			self.finish(task, m)
+
+	def write_loop(self):
+		while True:
+			job = self.write_queue.get()
+			if job is None:
+				self.write_queue.task_done()
+				break
+			self.write_tile(*job)
+			self.write_queue.task_done()
+
+	def deep_features(self, x, y, z):
+		# Whether a layer that may appear only at higher zoom levels has
+		# features within a tile or its buffer
+		tile = RenderTask(1, z, x, y)
+		tile.prj = self.prj
+		bbox = tile.get_bbox(TILE_SIZE // 2)
+		for layer in self.deep:
+			box = bbox
+			if layer.srs != self.m.srs:
+				box = mapnik.ProjTransform(self.prj, mapnik.Projection(layer.srs)).forward(bbox)
+			features = layer.datasource.features(mapnik.Query(box))
+			try:
+				# Older Mapnik returns None at the end
+				if features.next() is not None:
+					return True
+			except StopIteration:
+				pass
+		return False
+
+	def find_blank(self, im, task):
+		# (x, y, color) of the tiles of a rendered metatile in a single color,
+		# without features of the deep layers
+		result = []
+		for t in task.tiles():
+			view = im if task.metatile == 1 else im.view(t[3] * self.scaled_size, t[4] * self.scaled_size, self.scaled_size, self.scaled_size)
+			color = uniform_color(view.tostring())
+			if color is not None and not self.deep_features(t[0], t[1], t[2]):
+				result.append((t[0], t[1], color))
+		return result
+
+	def fill_data(self, color, format):
+		if (color, format) not in self.fills:
+			im = mapnik.Image(self.scaled_size, self.scaled_size)
+			c = mapnik.Color(*[ord(b) for b in color])
+			if hasattr(im, 'fill'):
+				im.fill(c)
+			else:
+				im.background = c
+			self.fills[(color, format)] = im.tostring(format)
+		return self.fills[(color, format)]
+
+	def fill_task(self, task):
+		# Tiles under blank tiles of the level above get their color without
+		# rendering, every color is encoded only once
+		m = MetatileMetrics(task, self.worker)
+		writer = self.writer_for(task)
+		start = time.time()
+		data = None if writer.skip_empty() else self.fill_data(task.fill, writer.format)
+		m.record['encode'] = time.time() - start
+		start = time.time()
+		for t in task.tiles():
+			if data is None:
+				m.record['empty'] += 1
+			else:
+				writer.write(t[0], t[1], t[2], FakeImage(data))
+				m.record['bytes'] += len(data)
+		m.record['write'] = time.time() - start
+		self.finish(task, m)
 
 	def render_task(self, task):
+		if task.fill is not None:
+			self.fill_task(task)
+			return
+		m = MetatileMetrics(task, self.worker)
+		start = time.time()
 		bbox = task.get_bbox()
+		m.record['bbox'] = time.time() - start
+		start = time.time()
 		render_size = task.metatile * self.scaled_size
 		self.m.resize(render_size, render_size)
 		self.m.zoom_to_box(bbox)
 		self.m.buffer_size = self.scaled_size / 2
 
 		# Render image with default Agg renderer
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
 		im = mapnik.Image(render_size, render_size)
 		mapnik.render(self.m, im, self.scale)
+		m.record['render'] = time.time() - start
+		if self.feedback:
+			# ru_maxrss never goes down, it only tells about this render if it grew
+			rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			self.feedback.put((task.zoom, task.metatile, m.record['render'], rss if rss > peak else 0))
+		if self.blanks is not None and (self.blank_zooms is None or task.zoom in self.blank_zooms):
+			self.blanks.put((task.zoom, self.find_blank(im, task)))
 
 		# Now cut parts of the image to tiles
-		for t in task.tiles():
-			self.writer.write(t[0], t[1], t[2], im if task.metatile == 1 else im.view(t[3] * self.scaled_size, t[4] * self.scaled_size, self.scaled_size, self.scaled_size))
-			if self.verbose:
-				self.printLock.acquire()
-				print t[2], t[0], t[1]
-				self.printLock.release()
+		tiles = list(task.tiles())
+		if not tiles:
+			self.finish(task, m)
+		for t in tiles:
+			if self.io_threads:
+				self.write_queue.put((im, t, task, m))
+			else:
+				self.write_tile(im, t, task, m)
+
+	def load(self):
+		self.m = mapnik.Map(self.scaled_size, self.scaled_size)
+		# Load style XML
+		mapnik.load_map(self.m, self.mapfile, True)
+		# Obtain <Map> projection
+		self.prj = mapnik.Projection(self.m.srs)
+		if self.blanks is not None:
+			self.deep = [l for l in self.m.layers if l.name in self.deep_layers]
 
 	def loop(self):
-		if self.writer.need_image():
-			self.m = mapnik.Map(self.scaled_size, self.scaled_size)
-			# Load style XML
-			mapnik.load_map(self.m, self.mapfile, True)
-			# Obtain <Map> projection
-			prj = mapnik.Projection(self.m.srs)
+		if self.feedback:
+			# Nobody reads the feedback after the last task, do not wait for it on exit
+			self.feedback.cancel_join_thread()
+		if self.blanks:
+			self.blanks.cancel_join_thread()
+		need_image = not self.writer or self.writer.need_image()
+		if need_image:
+			self.load()
+
+		if self.io_threads:
+			self.write_queue = Queue.Queue(WRITE_QUEUE_LENGTH)
+			workers = [threading.Thread(target=self.write_loop) for i in range(self.io_threads)]
+			for w in workers:
+				w.daemon = True
+				w.start()
 
 		while True:
-			#Fetch a tile from the queue and render it
-			task = self.q.get()
-			if (task == None):
+			#Fetch a batch of metatiles from the queue and render them
+			batch = self.q.get()
+			if (batch == None):
 				self.q.task_done()
 				break
 
-			if self.writer.need_image():
-				task.prj = prj
-				self.render_task(task)
-			else:
-				for t in task.tiles():
-					self.writer.write(t[0], t[1], t[2])
-					if self.renderlist:
-						break
+			for packed in batch:
+				task = unpack_task(packed)
+				if need_image:
+					task.prj = self.prj
+					self.render_task(task)
+				else:
+					m = MetatileMetrics(task, self.worker)
+					start = time.time()
+					for t in task.tiles():
+						self.writer.write(t[0], t[1], t[2])
+						if self.renderlist:
+							break
+					self.writer.done(task.zoom, task.mtx0, task.mty0, task.metatile)
+					m.record['write'] = time.time() - start
+					with self.lock:
+						self.report(m)
 			self.q.task_done()
 
+		if self.io_threads:
+			for w in workers:
+				self.write_queue.put(None)
+			for w in workers:
+				w.join()
+		if self.writer:
+			self.writer.sync()
+		if self.metrics is not None:
+			self.send_metrics()
+
+class TaskFilter:
+	# Stands between a generator and the render queue, drops metatiles that
+	# were finished before, removes tiles that are already present and drops
+	# metatiles with nothing left to render
+	def __init__(self, queue, existing=None, finished=None):
+		self.queue = queue
+		self.existing = existing
+		self.finished = finished
+		self.skipped = 0
+
+	def put(self, task):
+		if self.finished and (task.zoom, task.mtx0, task.mty0, task.metatile) in self.finished:
+			self.skipped += 1
+			return
+		if self.existing is not None:
+			for t in list(task.tiles()):
+				if (t[0], t[1], t[2]) in self.existing:
+					task.discard(t[0], t[1])
+		if task.empty():
+			self.skipped += 1
+		else:
+			self.queue.put(task)
+
 class ListGenerator:
-	def __init__(self, f, metatile=1):
+	def __init__(self, f, metatile=1, order=None):
 		self.f = f
 		self.metatile = metatile
+		# Metatiles of a zoom level are sorted by this, column by column without it
+		self.order = ORDERS.get(order)
+		self.tiles = 0
+		self.metatiles = 0
+		# Renders saved compared to grouping within a window of recent metatiles
+		self.merged = 0
 
 	def __str__(self):
 		return "ListGenerator({0})".format(self.f.name)
 
-	def generate(self, queue):
-		import re
-		metatiles = []
-		for line in self.f:
+	def summary(self):
+		return "Grouped {0} tiles into {1} metatiles, {2} renders merged".format(self.tiles, self.metatiles, self.merged)
+
+	def step(self):
+		# Size of the blocks metatiles are made of
+		return self.metatile
+
+	def reset(self):
+		# For another pass over the list
+		self.f.seek(0)
+		self.tiles = 0
+		self.metatiles = 0
+		self.merged = 0
+
+	def read(self):
+		first = self.f.readline()
+		if first == LIST_MAGIC:
+			for t in read_binary_list(self.f):
+				yield t
+			return
+		for line in itertools.chain([first], self.f):
+			if line.startswith('BBox:'):
+				continue
 			m = re.search(r"(\d+)\D+(\d+)\D+(\d{1,2})", line)
 			if m:
-				x = int(m.group(1))
-				y = int(m.group(2))
-				z = int(m.group(3))
-				if self.metatile == 1:
-					queue.put(RenderTask(1, z, x, y))
-				else:
-					n = -1
-					for i in range(len(metatiles)):
-						if metatiles[i].belongs(x, y, z=z):
-							n = i
-							break
-					if n >= 0:
-						m = metatiles.pop(n)
-					else:
-						m = RenderTask(self.metatile, z, x, y)
-						while len(metatiles) >= LIST_QUEUE_LENGTH:
-							queue.put(metatiles.pop(0))
-					m.add(x, y)
-					metatiles.append(m)
-		for m in metatiles:
-			queue.put(m)
+				yield (int(m.group(1)), int(m.group(2)), int(m.group(3)))
+
+	def key(self, x, y, z):
+		x0 = x - x % self.metatile
+		y0 = y - y % self.metatile
+		return (z, self.order(z, x0, y0) if self.order else 0, x0, y0)
+
+	def spill(self, groups):
+		# Writes a sorted run of "z key x0 y0 x y" lines
+		run = tempfile.TemporaryFile()
+		for key in sorted(groups):
+			prefix = "{0} {1} {2} {3}".format(*key)
+			for (x, y) in groups[key]:
+				run.write("{0} {1} {2}\n".format(prefix, x, y))
+		run.seek(0)
+		return run
+
+	def read_run(self, run):
+		for line in run:
+			v = [int(i) for i in line.split()]
+			yield (tuple(v[:4]), (v[4], v[5]))
+		run.close()
+
+	def merge(self, runs, groups):
+		# (key, tiles) of every metatile in order, from the runs and from memory
+		if not runs:
+			for key in sorted(groups):
+				yield key, groups[key]
+			return
+		streams = [self.read_run(run) for run in runs]
+		streams.append((key, t) for key in sorted(groups) for t in groups[key])
+		current = None
+		tiles = []
+		for key, t in heapq.merge(*streams):
+			if key != current:
+				if tiles:
+					yield current, tiles
+				current = key
+				tiles = []
+			tiles.append(t)
+		if tiles:
+			yield current, tiles
 
+	def generate(self, queue):
+		groups = {}
+		grouped = 0
+		runs = []
+		# Metatiles the list would take with a window of LIST_QUEUE_LENGTH
+		window = OrderedDict()
+		windowed = 0
+		for (x, y, z) in self.read():
+			key = self.key(x, y, z)
+			if key in window:
+				del window[key]
+			elif len(window) >= LIST_QUEUE_LENGTH:
+				window.popitem(last=False)
+				windowed += 1
+			window[key] = True
+
+			groups.setdefault(key, []).append((x, y))
+			self.tiles += 1
+			grouped += 1
+			if grouped >= LIST_GROUP_TILES:
+				runs.append(self.spill(groups))
+				groups = {}
+				grouped = 0
+		windowed = self.tiles if self.metatile == 1 else windowed + len(window)
+
+		for key, tiles in self.merge(runs, groups):
+			t = RenderTask(self.metatile, key[0], key[2], key[3])
+			for (x, y) in tiles:
+				t.add(x, y)
+			queue.put(t)
+			self.metatiles += 1
+		self.merged = windowed - self.metatiles
+
+
+class MetatileSizer:
+	# Chooses metatile sizes for --meta auto. Blocks of the largest allowed size
+	# are split into quarters while the polygon covers less than half of a block,
+	# while a render of that size is expected to take longer than the target, or
+	# when render processes went over the memory limit with that size. Until a
+	# zoom or a zoom above it has reported render times, blocks are not
+	# larger than the default. The limit goes up one size again after
+	# SIZER_RECOVERY renders at the limit that stayed within memory.
+	def __init__(self, sizes, target=10.0, memory=2048, default=8, feedback=None):
+		self.sizes = sorted(sizes)
+		self.target = target
+		# ru_maxrss is in kilobytes
+		self.memory = memory * 1024
+		self.default = default
+		self.feedback = feedback
+		# Seconds per rendered tile, per zoom
+		self.cost = {}
+		self.limit = self.sizes[-1]
+		self.calm = 0
+		self.chosen = {}
+
+	def largest(self):
+		return self.sizes[-1]
+
+	def update(self):
+		while self.feedback:
+			try:
+				(z, metatile, seconds, rss) = self.feedback.get_nowait()
+			except Queue.Empty:
+				break
+			cost = seconds / (metatile * metatile)
+			self.cost[z] = cost if z not in self.cost else 0.8 * self.cost[z] + 0.2 * cost
+			if rss > self.memory and metatile > self.sizes[0]:
+				self.limit = min(self.limit, metatile // 2)
+				self.calm = 0
+			elif metatile >= self.limit and self.limit < self.sizes[-1]:
+				self.calm += 1
+				if self.calm >= SIZER_RECOVERY:
+					self.limit = min(s for s in self.sizes if s > self.limit)
+					self.calm = 0
+
+	def too_big(self, z, metatile, count):
+		if metatile == self.sizes[0]:
+			return False
+		if metatile not in self.sizes or metatile > self.limit or count * 2 < metatile * metatile:
+			return True
+		# A zoom without render times yet starts from the closest one above it
+		above = [k for k in self.cost if k <= z]
+		cost = self.cost[max(above)] if above else None
+		if cost is None:
+			return metatile > self.default
+		return cost * metatile * metatile > self.target
+
+	def split(self, z, x0, y0, metatile, tiles):
+		if self.too_big(z, metatile, len(tiles)):
+			half = metatile // 2
+			for dx in (0, half):
+				for dy in (0, half):
+					part = [t for t in tiles if x0 + dx <= t[0] < x0 + dx + half and y0 + dy <= t[1] < y0 + dy + half]
+					if part:
+						for task in self.split(z, x0 + dx, y0 + dy, half, part):
+							yield task
+		else:
+			self.chosen[(z, metatile)] = self.chosen.get((z, metatile), 0) + 1
+			task = RenderTask(metatile, z, x0, y0)
+			for (x, y) in tiles:
+				task.add(x, y)
+			yield task
+
+	def summary(self):
+		zooms = {}
+		for (z, metatile), count in sorted(self.chosen.items()):
+			zooms.setdefault(z, []).append("{0}x{0}: {1}".format(metatile, count))
+		return "; ".join(["z{0} {1}".format(z, ", ".join(zooms[z])) for z in sorted(zooms)])
 
 class PolyGenerator:
-	def __init__(self, poly, zooms, metatile=1):
+	def __init__(self, poly, zooms, metatile=1, sizer=None, order=None, interleave=False, exact=False):
 		self.poly = poly
-		self.zooms = zooms
-		self.zooms.sort()
+		# Test tiles against the full resolution polygon at every zoom, small
+		# polygons always are
+		self.exact = exact or vertices(poly) < AREA_MIN_VERTICES
+		self.prepared = prep(self.poly)
+		self.areas = {}
+		self.zooms = sorted(set(zooms))
 		self.metatile = metatile
+		# Picks metatile sizes per block when set, instead of the fixed metatile
+		self.sizer = sizer
+		# Sort key for metatiles of a zoom level, column by column without one
+		self.order = ORDERS.get(order)
+		# Mix the metatiles of all zoom levels instead of one level after another
+		self.interleave = interleave
 
 	def __str__(self):
 		return "PolyGenerator({0}, {1})".format(self.poly.bounds, self.zooms)
 
-	def check_tile(self, x, y, z):
-		# Calculate pixel positions of bottom-left & top-right
-		tt_p0 = (x * TILE_SIZE, (y + 1) * TILE_SIZE)
-		tt_p1 = ((x + 1) * TILE_SIZE, y * TILE_SIZE)
+	def area(self, z):
+		# (outline, prepared outline, tolerance) of the polygon for the tiles of
+		# zoom z. Each level is simplified from the next finer one by a fraction
+		# of its tile size and stays within the sum of those tolerances of the
+		# polygon, so tiles grown by it that miss the outline miss the polygon.
+		if z not in self.areas:
+			if z < self.zooms[-1]:
+				(outline, prepared, tolerance) = self.area(z + 1)
+			else:
+				(outline, prepared, tolerance) = (self.poly, self.prepared, 0.0)
+			if not self.exact:
+				step = 360.0 / 2**z * AREA_TOLERANCE
+				simple = outline.simplify(step)
+				if not simple.is_valid and hasattr(simple, 'geoms'):
+					# Parts of a collection may overlap after simplification
+					simple = unary_union(list(simple.geoms))
+				if simple.is_valid and vertices(simple) < vertices(outline):
+					(outline, prepared, tolerance) = (simple, prep(simple), tolerance + step)
+			self.areas[z] = (outline, prepared, tolerance)
+		return self.areas[z]
+
+	def tile_box(self, x, y, z, t=0.0):
+		# Grown by t on every side
+		(lons, lats) = self.gprj.tile_edges(z)
+		return box(lons[x] - t, lats[y] + t, lons[x + 1] + t, lats[y + 1] - t)
 
-		# Convert to LatLong (EPSG:4326)
-		tt_l0 = self.gprj.fromPixelToLL(tt_p0, z);
-		tt_l1 = self.gprj.fromPixelToLL(tt_p1, z);
+	def check_tile(self, x, y, z):
+		# The simplified outline only rules tiles out, a tile it keeps is
+		# confirmed against the full polygon
+		(outline, prepared, t) = self.area(z)
+		if not prepared.intersects(self.tile_box(x, y, z, t)):
+			return False
+		return t == 0.0 or self.prepared.intersects(self.tile_box(x, y, z))
+
+	def tile_range(self, z, t=0.0):
+		# Tiles covering the polygon bounding box grown by t
+		bbox = self.poly.bounds
+		px0 = self.gprj.fromLLtoPixel((bbox[0] - t, bbox[3] + t), z)
+		px1 = self.gprj.fromLLtoPixel((bbox[2] + t, bbox[1] - t), z)
+
+		xmin = max(0, min(2**z - 1, int(px0[0]/float(TILE_SIZE))))
+		xmax = max(0, min(2**z - 1, int(px1[0]/float(TILE_SIZE))))
+		ymin = max(0, min(2**z - 1, int(px0[1]/float(TILE_SIZE))))
+		ymax = max(0, min(2**z - 1, int(px1[1]/float(TILE_SIZE))))
+		return (xmin, xmax, ymin, ymax)
+
+	def sure_tiles(self, y, z, part, b, lo, hi):
+		# Tiles lo..hi of row y that surely overlap the piece part with bounds b
+		# of the row, as (first, last). A simplified outline only counts where it
+		# runs at least its tolerance inside a tile, since the polygon is never
+		# farther away from it than that.
+		(lons, lats) = self.gprj.tile_edges(z)
+		t = self.area(z)[2]
+		pieces = [(part, b)]
+		if t > 0.0:
+			if lats[y] - t <= lats[y + 1] + t:
+				return []
+			core = clip_by_rect(part, b[0], lats[y + 1] + t, b[2], lats[y] - t)
+			pieces = [(piece, piece.bounds) for piece in (core.geoms if hasattr(core, 'geoms') else [core]) if not piece.is_empty]
+		sure = []
+		for (piece, b) in pieces:
+			first = max(lo, bisect_right(lons, b[0] + t + SPAN_EPSILON) - 1)
+			last = min(hi, bisect_left(lons, b[2] - t - SPAN_EPSILON) - 1)
+			if first <= last:
+				sure.append((first, last))
+		return merge_spans(sure)
+
+	def row_spans(self, y, z, xmin, xmax):
+		# Cut the polygon with the whole tile row: every connected piece covers
+		# a continuous run of tiles, so only the tiles around the sure ones need
+		# an exact test
+		(lons, lats) = self.gprj.tile_edges(z)
+		(outline, prepared, t) = self.area(z)
+		strip = outline.intersection(box(lons[xmin] - t, lats[y + 1] - t, lons[xmax + 1] + t, lats[y] + t))
+		if strip.is_empty:
+			return []
+		parts = strip.geoms if hasattr(strip, 'geoms') else [strip]
+
+		spans = []
+		for part in parts:
+			if part.is_empty:
+				continue
+			b = part.bounds
+			lo = max(xmin, bisect_right(lons, b[0] - t) - 2)
+			hi = min(xmax, bisect_right(lons, b[2] + t))
+
+			x = lo
+			for (first, last) in self.sure_tiles(y, z, part, b, lo, hi) + [(hi + 1, hi)]:
+				while x < first:
+					if lons[x] - t <= b[2] + SPAN_EPSILON and lons[x + 1] + t >= b[0] - SPAN_EPSILON and self.check_tile(x, y, z):
+						spans.append((x, x))
+					x += 1
+				if first <= last:
+					spans.append((first, last))
+				x = last + 1
+		return merge_spans(spans)
+
+	def coverage(self, z):
+		# Covered tiles of a zoom level as {y: [(xmin, xmax), ...]}; the outline
+		# and the tiles grown to test it stay within twice its tolerance
+		(xmin, xmax, ymin, ymax) = self.tile_range(z, 2 * self.area(z)[2])
+		rows = {}
+		for y in range(ymin, ymax + 1):
+			spans = self.row_spans(y, z, xmin, xmax)
+			if spans:
+				rows[y] = spans
+		return rows
+
+	def quadtree_rows(self, z, inside, boundary):
+		# Covered tiles of a zoom level from the quadtree, as in coverage()
+		(xmin, xmax, ymin, ymax) = self.tile_range(z)
+		rows = {}
+		for (level, x, y) in inside:
+			d = z - level
+			xa = max(xmin, x << d)
+			xb = min(xmax, ((x + 1) << d) - 1)
+			if xa > xb:
+				continue
+			for ty in range(max(ymin, y << d), min(ymax, ((y + 1) << d) - 1) + 1):
+				rows.setdefault(ty, []).append((xa, xb))
+		for (x, y) in boundary:
+			if x >= xmin and x <= xmax and y >= ymin and y <= ymax:
+				rows.setdefault(y, []).append((x, x))
+		for y in rows:
+			rows[y] = merge_spans(rows[y])
+		return rows
+
+	def coverages(self):
+		# Yields (zoom, rows) for every zoom level, see coverage()
+		if len(self.zooms) == 1:
+			yield self.zooms[0], self.coverage(self.zooms[0])
+			return
 
-		tt_p = box(tt_l0[0], tt_l1[1], tt_l1[0], tt_l0[1])
-		return self.poly.intersects(tt_p)
+		# Descend the tile quadtree: children of a tile inside the polygon are
+		# all covered and children of a disjoint tile are not, so only tiles on
+		# the polygon boundary are tested again at the next level. Prepared
+		# tests take about as long on the full polygon as on a simplified one.
+		inside = []
+		boundary = [(0, 0)] if self.prepared.intersects(self.tile_box(0, 0, 0)) else []
+		level = 0
+		for z in self.zooms:
+			while level < z:
+				level += 1
+				refined = []
+				for (x, y) in boundary:
+					for cx in (2 * x, 2 * x + 1):
+						for cy in (2 * y, 2 * y + 1):
+							tt_p = self.tile_box(cx, cy, level)
+							if not self.prepared.intersects(tt_p):
+								continue
+							if level < self.zooms[-1] and self.prepared.contains(tt_p):
+								inside.append((level, cx, cy))
+							else:
+								refined.append((cx, cy))
+				boundary = refined
+			yield z, self.quadtree_rows(z, inside, boundary)
+
+	def step(self):
+		# Size of the blocks metatiles are made of
+		return self.sizer.largest() if self.sizer else self.metatile
+
+	def reset(self):
+		# For another pass, which chooses the metatile sizes again
+		if self.sizer:
+			self.sizer.chosen = {}
 
 	def generate(self, queue):
 		self.gprj = GoogleProjection(self.zooms[-1]+1)
 
-		bbox = self.poly.bounds
-		ll0 = (bbox[0], bbox[3])
-		ll1 = (bbox[2], bbox[1])
-
-		for z in self.zooms:
-			px0 = self.gprj.fromLLtoPixel(ll0, z)
-			px1 = self.gprj.fromLLtoPixel(ll1, z)
-
-			xmin = max(0, min(2**z - 1, int(px0[0]/float(TILE_SIZE))))
-			xmax = max(0, min(2**z - 1, int(px1[0]/float(TILE_SIZE))))
-			ymin = max(0, min(2**z - 1, int(px0[1]/float(TILE_SIZE))))
-			ymax = max(0, min(2**z - 1, int(px1[1]/float(TILE_SIZE))))
-
-			x0_min = xmin - xmin % self.metatile
-			y0_min = ymin - ymin % self.metatile
-			x0_max = xmax - xmax % self.metatile
-			y0_max = ymax - ymax % self.metatile
-
-			for x0 in range(x0_min, x0_max + 1, self.metatile):
-				for y0 in range(y0_min, y0_max + 1, self.metatile):
-					t = None
-					for x in range(x0, x0 + self.metatile):
-						for y in range(y0, y0 + self.metatile):
-							if x >= xmin and x <= xmax and y >= ymin and y <= ymax:
-								if self.check_tile(x, y, z):
-									if not t:
-										t = RenderTask(self.metatile, z, x0, y0)
-									t.add(x, y)
-					if t:
+		step = self.step()
+		if not self.interleave:
+			for z, rows in self.coverages():
+				for (x0, y0) in self.blocks(z, rows, step):
+					for t in self.block_tasks(z, rows, x0, y0, step):
 						queue.put(t)
+			return
+
+		# Every step advances the zoom level that is the furthest behind, so all
+		# levels move over the area together and none is left alone at the end
+		streams = []
+		for z, rows in self.coverages():
+			count = self.block_count(z, rows, step)
+			if count:
+				streams.append([0, count, self.blocks(z, rows, step), z, rows])
+		while streams:
+			stream = min(streams, key=lambda s: float(s[0]) / s[1])
+			(done, count, blocks, z, rows) = stream
+			(x0, y0) = next(blocks)
+			for t in self.block_tasks(z, rows, x0, y0, step):
+				queue.put(t)
+			stream[0] += 1
+			if stream[0] == count:
+				streams.remove(stream)
+
+	def block_tasks(self, z, rows, x0, y0, step):
+		# Render tasks for the covered tiles of one step x step block
+		tiles = []
+		for y in range(y0, y0 + step):
+			for span in rows.get(y, ()):
+				if span[0] >= x0 + step:
+					break
+				for x in range(max(x0, span[0]), min(x0 + step - 1, span[1]) + 1):
+					tiles.append((x, y))
+		if not tiles:
+			return []
+		if self.sizer:
+			self.sizer.update()
+			return list(self.sizer.split(z, x0, y0, step, tiles))
+		t = RenderTask(step, z, x0, y0)
+		for (x, y) in tiles:
+			t.add(x, y)
+		return [t]
+
+	def blocks(self, z, rows, step):
+		# Top left tiles of the metatiles to look at, in rendering order
+		if not self.order:
+			(xmin, xmax, ymin, ymax) = self.tile_range(z)
+			for x0 in range(xmin - xmin % step, xmax + 1, step):
+				for y0 in range(ymin - ymin % step, ymax + 1, step):
+					yield (x0, y0)
+			return
+		blocks = set()
+		for y, spans in rows.items():
+			for span in spans:
+				for x0 in range(span[0] - span[0] % step, span[1] + 1, step):
+					blocks.add((x0, y - y % step))
+		for b in sorted(blocks, key=lambda b: self.order(z, b[0], b[1])):
+			yield b
+
+	def block_count(self, z, rows, step):
+		# Number of blocks that blocks() yields, without keeping them
+		if not self.order:
+			(xmin, xmax, ymin, ymax) = self.tile_range(z)
+			return (xmax // step - xmin // step + 1) * (ymax // step - ymin // step + 1)
+		count = 0
+		for y0 in set(y - y % step for y in rows):
+			spans = merge_spans([(span[0] // step, span[1] // step) for y in range(y0, y0 + step) for span in rows.get(y, ())])
+			count += sum(b - a + 1 for (a, b) in spans)
+		return count
+
+
+class Shard:
+	# Part index of count of the metatiles of a generator, for rendering one
+	# zone on several machines. A first pass orders the blocks of every zoom
+	# level along the Hilbert curve and cuts them into count contiguous chunks
+	# of about the same number of tiles; the same generator gives the same
+	# chunks on every machine. Metatiles are assigned by the block they lie in,
+	# so --meta auto may split blocks differently on every machine.
+	def __init__(self, generator, index, count):
+		self.generator = generator
+		self.index = index
+		self.count = count
+		self.block = generator.step()
+		# {zoom: (first key, first key of the next shard or None)}
+		self.ranges = None
+		self.blocks = {}
+		self.queue = None
+		self.metatiles = 0
+		self.tiles = 0
+		self.total = 0
+
+	def __str__(self):
+		return "Shard({0}/{1}, {2})".format(self.index + 1, self.count, self.generator)
+
+	def summary(self):
+		return "Shard {0}/{1}: {2} of {3} tiles in {4} metatiles".format(self.index + 1, self.count, self.tiles, self.total, self.metatiles)
+
+	def key(self, task):
+		return hilbert_key(task.zoom, task.mtx0 - task.mtx0 % self.block, task.mty0 - task.mty0 % self.block)
+
+	def plan(self):
+		self.generator.generate(self)
+		self.generator.reset()
+		self.ranges = {}
+		for z, blocks in self.blocks.items():
+			total = sum(blocks.values())
+			self.total += total
+			first = None
+			end = None
+			done = 0
+			for key in sorted(blocks):
+				# Shard of the block from the middle of its tiles
+				shard = min(self.count - 1, int((done + blocks[key] / 2.0) * self.count / total))
+				done += blocks[key]
+				if shard == self.index and first is None:
+					first = key
+				elif shard > self.index:
+					end = key
+					break
+			if first is not None:
+				self.ranges[z] = (first, end)
+		self.blocks = {}
+
+	def put(self, task):
+		key = self.key(task)
+		if self.ranges is None:
+			blocks = self.blocks.setdefault(task.zoom, {})
+			blocks[key] = blocks.get(key, 0) + task.count()
+			return
+		keys = self.ranges.get(task.zoom)
+		if keys and key >= keys[0] and (keys[1] is None or key < keys[1]):
+			self.metatiles += 1
+			self.tiles += task.count()
+			self.queue.put(task)
+
+	def generate(self, queue):
+		if self.ranges is None:
+			self.plan()
+		self.queue = queue
+		self.generator.generate(self)
+
+def shard_spec(value):
+	# "I/N" for --shard, counting from 1
+	try:
+		(index, count) = [int(v) for v in value.split('/')]
+	except ValueError:
+		raise argparse.ArgumentTypeError("expected I/N, e.g. 2/4")
+	if not 1 <= index <= count:
+		raise argparse.ArgumentTypeError("expected 1 <= I <= N")
+	return (index - 1, count)
+
+def read_tiles(source, format='png256', tms=False):
+	# (x, y, z, data) of all tiles in a tile directory or an MBTiles file
+	if os.path.isfile(source):
+		con = sqlite3.connect(source)
+		cur = con.cursor()
+		cur.execute("""select zoom_level, tile_column, tile_row, tile_data from tiles;""")
+		for (z, x, y, data) in cur:
+			yield (x, 2**z-1-y, z, str(data))
+		con.close()
+		return
+	for (z, x, y, path) in tile_files(source, '.' + format2ext(format)):
+		with open(path, 'rb') as f:
+			yield (x, y if not tms else 2**z-1-y, z, f.read())
+
+def tile_files(tile_dir, ext):
+	# (z, x, y, path) of the tiles in a tile directory, y as in the file names
+	for zdir in sorted(os.listdir(tile_dir)):
+		if not zdir.isdigit():
+			continue
+		for xdir in sorted(os.listdir(os.path.join(tile_dir, zdir))):
+			if not xdir.isdigit():
+				continue
+			path = os.path.join(tile_dir, zdir, xdir)
+			for name in sorted(os.listdir(path)):
+				if name.endswith(ext) and name[:-len(ext)].isdigit():
+					yield (int(zdir), int(xdir), int(name[:-len(ext)]), os.path.join(path, name))
+
+def merge_shards(sources, writer, format='png256', tms=False, verbose=True):
+	# Copies the tiles of shard outputs into one writer as they are, without
+	# decoding or encoding them again
+	for source in sources:
+		count = 0
+		for (x, y, z, data) in read_tiles(source, format, tms):
+			writer.write(x, y, z, FakeImage(data))
+			count += 1
+		writer.sync()
+		if verbose:
+			print "Merged {0} tiles from {1}".format(count, source)
+
+def png_optimizer():
+	# Command line of the PNG optimizer to use, without the file name
+	for (name, args) in PNG_OPTIMIZERS:
+		for path in os.environ.get('PATH', '').split(os.pathsep):
+			tool = os.path.join(path, name)
+			if os.path.isfile(tool) and os.access(tool, os.X_OK):
+				return [tool] + args
+	return None
+
+def optimize_tile(job):
+	# New data for a tile, None to keep it as it is
+	data, webp, tool = job
+	if webp:
+		try:
+			return mapnik.Image.fromstring(data).tostring(webp)
+		except RuntimeError:
+			return None
+	if not tool:
+		return None
+	(fd, path) = tempfile.mkstemp(suffix='.png')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(data)
+		with open(os.devnull, 'w') as devnull:
+			if call(tool + [path], stdout=devnull, stderr=devnull) != 0:
+				return None
+		with open(path, 'rb') as f:
+			result = f.read()
+	finally:
+		os.remove(path)
+	return result if len(result) < len(data) else None
+
+class TileOptimizer:
+	# Recompresses the tiles of a tile directory or an MBTiles file in place.
+	# The digests of tiles that are as small as they get are kept next to them
+	# (<tiledir>.optimized or <file>.mbtiles.optimized), so a later run only
+	# works on tiles that are new or changed since
+	def __init__(self, source, webp=None, format='png256'):
+		self.source = source
+		self.webp = webp
+		self.ext = format2ext(format)
+		# Without an optimizer PNG tiles are left as they are
+		self.tool = None if webp else png_optimizer()
+		self.tag = webp or 'png'
+		self.con = None
+		if os.path.isfile(source):
+			self.con = sqlite3.connect(source)
+			self.cur = self.con.cursor()
+			self.cur.execute("""select type from sqlite_master where name='tiles'""")
+			result = self.cur.fetchone()
+			self.dedup = result is not None and result[0] == 'view'
+		self.state = source.rstrip('/') + '.optimized'
+		self.known = set()
+		if os.path.exists(self.state):
+			with open(self.state, 'rb') as f:
+				data = f.read()
+			self.known.update(data[i:i + 16] for i in xrange(0, len(data) - 15, 16))
+		self.recorded = []
+		self.cache = OrderedDict()
+		self.zooms = {}
+
+	def __str__(self):
+		return "TileOptimizer({0})".format(self.source)
+
+	def tiles(self):
+		# (key, zoom, data) of all tiles, read in chunks
+		if self.con is None:
+			chunk = []
+			for (z, x, y, path) in tile_files(self.source, '.' + self.ext):
+				with open(path, 'rb') as f:
+					chunk.append((path, z, f.read()))
+				if len(chunk) == OPTIMIZE_CHUNK:
+					yield chunk
+					chunk = []
+			if chunk:
+				yield chunk
+			return
+		if self.dedup:
+			# images are shared, each is counted at the lowest zoom it is used on
+			self.cur.execute("""create temp table zooms as select tile_id, min(zoom_level) as zoom_level from map group by tile_id;""")
+			self.cur.execute("""create unique index temp.zooms_id on zooms (tile_id);""")
+			query = """select images.rowid, zooms.zoom_level, images.tile_data from images join zooms on zooms.tile_id = images.tile_id where images.rowid > ? order by images.rowid limit ?;"""
+		else:
+			query = """select rowid, zoom_level, tile_data from tiles where rowid > ? order by rowid limit ?;"""
+		last = -1
+		while True:
+			self.cur.execute(query, (last, OPTIMIZE_CHUNK))
+			rows = self.cur.fetchall()
+			if not rows:
+				break
+			last = rows[-1][0]
+			yield [(rowid, z, str(data)) for (rowid, z, data) in rows]
 
+	def store(self, key, data):
+		if self.con is not None:
+			self.cur.execute("""update {0} set tile_data = ? where rowid = ?;""".format('images' if self.dedup else 'tiles'), (sqlite3.Binary(data), key))
+			return
+		# a tile is replaced at once, an interrupted run leaves no broken tiles
+		uri = key[:-len(self.ext)] + format2ext(self.webp or self.ext)
+		with open(uri + '.tmp', 'wb') as f:
+			f.write(data)
+		os.rename(uri + '.tmp', uri)
+		if uri != key:
+			os.remove(key)
+
+	def record(self, digest):
+		if digest not in self.known:
+			self.known.add(digest)
+			self.recorded.append(digest)
+
+	def prepare(self, chunk):
+		# Distinct tile data of a chunk that needs work, and its tiles
+		jobs = OrderedDict()
+		tiles = []
+		for key, z, data in chunk:
+			zoom = self.zooms.setdefault(z, {'tiles': 0, 'done': 0, 'smaller': 0, 'failed': 0, 'before': 0, 'after': 0})
+			zoom['tiles'] += 1
+			zoom['before'] += len(data)
+			digest = hashlib.md5(self.tag + data).digest()
+			if digest in self.known:
+				zoom['done'] += 1
+				zoom['after'] += len(data)
+			elif digest in self.cache:
+				self.cache[digest] = self.cache.pop(digest)
+				tiles.append((key, z, len(data), digest))
+			else:
+				jobs[digest] = data
+				tiles.append((key, z, len(data), digest))
+		return jobs, tiles
+
+	def apply(self, jobs, tiles, result):
+		for digest, data in zip(jobs, result.get()):
+			self.cache[digest] = data
+			if len(self.cache) > OPTIMIZE_CACHE:
+				self.cache.popitem(last=False)
+		for key, z, size, digest in tiles:
+			data = self.cache[digest]
+			zoom = self.zooms[z]
+			if data is None:
+				zoom['after'] += size
+				if self.webp:
+					zoom['failed'] += 1
+				elif self.tool:
+					self.record(digest)
+				continue
+			self.store(key, data)
+			zoom['smaller'] += 1
+			zoom['after'] += len(data)
+			self.record(hashlib.md5(self.tag + data).digest())
+		# tiles are stored before their digests are
+		if self.con is not None:
+			self.con.commit()
+		with open(self.state, 'ab') as f:
+			f.write(''.join(self.recorded))
+		self.recorded = []
+
+	def run(self, threads=4):
+		# Tiles of the next chunk are read while the last one is worked on
+		pool = multiprocessing.Pool(threads)
+		pending = None
+		for chunk in self.tiles():
+			jobs, tiles = self.prepare(chunk)
+			result = pool.map_async(optimize_tile, [(data, self.webp, self.tool) for data in jobs.itervalues()], chunksize=4)
+			if pending:
+				self.apply(*pending)
+			pending = (jobs, tiles, result)
+		if pending:
+			self.apply(*pending)
+		pool.close()
+		pool.join()
+		if self.con is not None:
+			if self.webp:
+				self.cur.execute("""insert or replace into metadata (name, value) values ('format', ?);""", (format2ext(self.webp),))
+			self.con.commit()
+			# smaller tiles leave free pages behind
+			if [z for z in self.zooms.itervalues() if z['smaller']]:
+				self.cur.execute("""VACUUM;""")
+			self.con.close()
+
+	def summary(self):
+		lines = []
+		total = Counter()
+		for z in sorted(self.zooms):
+			zoom = self.zooms[z]
+			total.update(zoom)
+			lines.append(self.describe("z{0}".format(z), zoom))
+		lines.append(self.describe("Total", total))
+		return lines
+
+	def describe(self, name, zoom):
+		saved = zoom['before'] - zoom['after']
+		line = "{0}: {1} tiles, {2} {3}, {4} done before".format(name, zoom['tiles'], zoom['smaller'], 'converted' if self.webp else 'smaller', zoom['done'])
+		if zoom['failed']:
+			line += ", {0} failed".format(zoom['failed'])
+		return line + ", {0:.1f} MB -> {1:.1f} MB, {2:.1f} MB ({3:.1f}%) saved".format(zoom['before'] / 1048576.0, zoom['after'] / 1048576.0, saved / 1048576.0, 100.0 * saved / max(zoom['before'], 1))
+
+
+def format_duration(seconds):
+	seconds = int(seconds)
+	return "{0}:{1:02d}:{2:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class RunMetrics:
+	# Gathers the metatile records of all render processes in a thread of the
+	# main process: writes them as JSON lines, sums them up per zoom, keeps a
+	# Prometheus textfile up to date and prints the progress
+	def __init__(self, verbose=True, jsonl=None, prometheus=None):
+		self.records = multiprocessing.Queue()
+		self.verbose = verbose
+		self.jsonl = open(jsonl, 'w') if jsonl else None
+		self.prometheus = prometheus
+		self.zooms = {}
+		self.lock = threading.Lock()
+		# Sent by the generator, tiles of metatiles that were queued
+		self.queued = 0
+		self.queued_tiles = 0
+		self.generated = False
+		self.done = 0
+		self.tiles = 0
+		self.start = time.time()
+		self.reported = self.start
+		self.thread = threading.Thread(target=self.collect)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def queue(self, metatiles, tiles):
+		with self.lock:
+			self.queued += metatiles
+			self.queued_tiles += tiles
+
+	def queued_all(self):
+		with self.lock:
+			self.generated = True
+
+	def collect(self):
+		while True:
+			batch = self.records.get()
+			if batch is None:
+				break
+			if batch[0] == 'queued':
+				# Counts of a batch of the generator, see TaskBatcher
+				self.queue(batch[1], batch[2])
+				continue
+			if batch[0] == 'generated':
+				self.queued_all()
+				continue
+			for r in batch:
+				self.add(r)
+			if time.time() - self.reported >= PROGRESS_INTERVAL:
+				self.report()
+
+	def add(self, r):
+		if self.jsonl:
+			self.jsonl.write(json.dumps(r, sort_keys=True) + '\n')
+		if r['zoom'] not in self.zooms:
+			self.zooms[r['zoom']] = dict([(k, 0) for k in ('metatiles', 'tiles', 'empty', 'bytes')] + [(stage, 0.0) for stage in STAGES])
+		zoom = self.zooms[r['zoom']]
+		zoom['metatiles'] += 1
+		for k in ('tiles', 'empty', 'bytes') + STAGES:
+			zoom[k] += r[k]
+		with self.lock:
+			self.done += 1
+			self.tiles += r['tiles']
+
+	def progress(self):
+		with self.lock:
+			seconds = max(time.time() - self.start, 0.001)
+			rate = self.tiles / seconds
+			line = "{0}/{1}{2} metatiles, {3}/{4}{2} tiles, {5:.1f} tiles/s".format(self.done, self.queued, '' if self.generated else '+', self.tiles, self.queued_tiles, rate)
+			if self.generated and rate > 0 and self.tiles < self.queued_tiles:
+				line += ", ETA " + format_duration((self.queued_tiles - self.tiles) / rate)
+		return line
+
+	def report(self):
+		self.reported = time.time()
+		if self.verbose:
+			print self.progress()
+			sys.stdout.flush()
+		if self.prometheus:
+			self.write_prometheus()
+
+	def write_prometheus(self):
+		# Replaced in one rename, so a collector never reads half a file
+		lines = []
+		for name, key, kind in [('metatiles', 'metatiles', 'counter'), ('tiles', 'tiles', 'counter'), ('empty_tiles', 'empty', 'counter'), ('bytes', 'bytes', 'counter')]:
+			lines.append("# TYPE polytiles_{0}_total {1}".format(name, kind))
+			for z in sorted(self.zooms):
+				lines.append('polytiles_{0}_total{{zoom="{1}"}} {2}'.format(name, z, self.zooms[z][key]))
+		lines.append("# TYPE polytiles_stage_seconds_total counter")
+		for z in sorted(self.zooms):
+			for stage in STAGES:
+				lines.append('polytiles_stage_seconds_total{{zoom="{0}",stage="{1}"}} {2:.3f}'.format(z, stage, self.zooms[z][stage]))
+		with self.lock:
+			seconds = max(time.time() - self.start, 0.001)
+			lines.append("# TYPE polytiles_queued_tiles gauge")
+			lines.append("polytiles_queued_tiles {0}".format(self.queued_tiles))
+			lines.append("# TYPE polytiles_tiles_per_second gauge")
+			lines.append("polytiles_tiles_per_second {0:.3f}".format(self.tiles / seconds))
+			if self.generated and self.tiles:
+				lines.append("# TYPE polytiles_eta_seconds gauge")
+				lines.append("polytiles_eta_seconds {0:.0f}".format((self.queued_tiles - self.tiles) * seconds / self.tiles))
+		with open(self.prometheus + '.tmp', 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+		os.rename(self.prometheus + '.tmp', self.prometheus)
+
+	def summary(self):
+		lines = []
+		for z in sorted(self.zooms):
+			zoom = self.zooms[z]
+			lines.append("z{0}: {metatiles} metatiles, {tiles} tiles, {empty} empty, {1:.1f} MB, bbox {bbox:.1f}s, render {render:.1f}s, slice {slice:.1f}s, encode {encode:.1f}s, write {write:.1f}s".format(z, zoom['bytes'] / 1048576.0, **zoom))
+		return lines
 
-def render_tiles_multithreaded(generator, mapfile, writer, num_threads=2, verbose=True, scale=1.0, renderlist=False):
+	def close(self):
+		# Called once all render processes have sent their last records
+		self.records.put(None)
+		self.thread.join()
+		if self.jsonl:
+			for z in sorted(self.zooms):
+				record = dict(self.zooms[z], zoom=z, summary=True)
+				self.jsonl.write(json.dumps(record, sort_keys=True) + '\n')
+			self.jsonl.close()
+		if self.prometheus:
+			self.write_prometheus()
+		if self.verbose:
+			print "Done:", self.progress()
+			for line in self.summary():
+				print line
+
+def confidence(population, values):
+	# Estimated total of a stratum of population units from a simple random
+	# sample of their values, and the half width of its 95% confidence interval
+	n = len(values)
+	if not n:
+		return (0.0, 0.0)
+	mean = sum(values) / float(n)
+	variance = sum([(v - mean) ** 2 for v in values]) / (n - 1) if n > 1 else 0.0
+	return (population * mean, 1.96 * population * (variance / n * (1 - float(n) / population)) ** 0.5)
+
+class Estimator:
+	# Takes the metatiles of a generator in place of the render queue, counts
+	# them and their tiles per zoom and keeps a uniform random sample of up to
+	# samples metatiles per zoom. Rendering the samples gives the time, empty
+	# tiles and size of the whole run, with the zooms as strata.
+	def __init__(self, samples, seed=0):
+		self.samples = samples
+		self.random = random.Random(seed)
+		# {zoom: [metatiles, tiles, sample]}
+		self.zooms = {}
+		# {zoom: [(seconds, empty, bytes, blocks) of every rendered sample]}
+		self.results = {}
+
+	def put(self, task):
+		zoom = self.zooms.setdefault(task.zoom, [0, 0, []])
+		zoom[0] += 1
+		zoom[1] += task.count()
+		# Reservoir sampling
+		if len(zoom[2]) < self.samples:
+			zoom[2].append(task)
+		else:
+			i = self.random.randrange(zoom[0])
+			if i < self.samples:
+				zoom[2][i] = task
+
+	def render(self, mapfile, scale=1.0, format='png256'):
+		writer = SampleWriter(format)
+		metrics = Queue.Queue()
+		renderer = RenderThread(writer, mapfile, None, scale=scale, metrics=metrics)
+		renderer.load()
+		for z in sorted(self.zooms):
+			for task in self.zooms[z][2]:
+				blocks = writer.blocks
+				task.prj = renderer.prj
+				renderer.render_task(task)
+				renderer.send_metrics()
+				record = metrics.get()[0]
+				seconds = sum([record[stage] for stage in STAGES])
+				self.results.setdefault(z, []).append((seconds, record['empty'], record['bytes'], writer.blocks - blocks))
+
+	def report(self, threads=1, deleteempty=False):
+		total = {'seconds': [0.0, 0.0], 'empty': [0.0, 0.0], 'bytes': [0.0, 0.0], 'blocks': [0.0, 0.0]}
+		(metatiles_total, tiles) = (0, 0)
+		for z in sorted(self.zooms):
+			(metatiles, count, sample) = self.zooms[z]
+			metatiles_total += metatiles
+			tiles += count
+			line = "z{0}: {1} metatiles, {2} tiles".format(z, metatiles, count)
+			results = self.results.get(z)
+			if results:
+				estimate = {}
+				for i, key in enumerate(['seconds', 'empty', 'bytes', 'blocks']):
+					estimate[key] = confidence(metatiles, [r[i] for r in results])
+					total[key][0] += estimate[key][0]
+					total[key][1] += estimate[key][1] ** 2
+				line += ", {0} rendered: {1}".format(len(results), self.describe(estimate, count, threads, deleteempty))
+			print line
+		line = "Total: {0} metatiles, {1} tiles".format(metatiles_total, tiles)
+		if self.results:
+			estimate = dict([(key, (v[0], v[1] ** 0.5)) for key, v in total.items()])
+			line += ", {0}".format(self.describe(estimate, tiles, threads, deleteempty))
+		print line
+
+	def describe(self, estimate, tiles, threads, deleteempty):
+		# Empty tiles that are written take a block each
+		blocks = estimate['blocks'][0] + (0 if deleteempty else estimate['empty'][0])
+		return "time {0} +- {1} with {2} processes, {3:.1f}% +- {4:.1f}% empty, {5:.1f} +- {6:.1f} MB encoded, {7:.1f} MB on disk".format(
+			format_duration(estimate['seconds'][0] / threads), format_duration(estimate['seconds'][1] / threads), threads,
+			100.0 * estimate['empty'][0] / max(tiles, 1), 100.0 * estimate['empty'][1] / max(tiles, 1),
+			estimate['bytes'][0] / 1048576.0, estimate['bytes'][1] / 1048576.0, blocks * BLOCK_SIZE / 1048576.0)
+
+def generate(generator, queue, existing, finished, verbose):
+	if existing is None and not finished:
+		generator.generate(queue)
+	else:
+		tasks = TaskFilter(queue, existing, finished)
+		generator.generate(tasks)
+		if verbose:
+			print "Skipped {0} metatiles that are already done".format(tasks.skipped)
+
+class TaskProducer(multiprocessing.Process):
+	# Runs the generator in a process of its own, so it does not compete with
+	# the main process and keeps up to the queue depth of batches ahead of the
+	# render processes. Summary lines of the generator come back at the end.
+	def __init__(self, generator, queue, batch=TASK_BATCH, existing=None, finished=None, verbose=True, records=None, summary=None, stop=0, blanks=None, blank_zooms=None):
+		super(TaskProducer, self).__init__()
+		self.generator = generator
+		self.queue = queue
+		self.batch = batch
+		self.existing = existing
+		self.finished = finished
+		self.verbose = verbose
+		self.records = records
+		self.summary = summary
+		# Ends for render processes to put after the last batch
+		self.stop = stop
+		# Blank tiles reported by the render processes, for --skip-blank
+		self.blanks = blanks
+		self.blank_zooms = blank_zooms
+		self.lines = multiprocessing.Queue()
+
+	def run(self):
+		try:
+			tasks = TaskBatcher(self.queue, self.batch, self.records)
+			blank = BlankFilter(tasks, self.blanks, self.blank_zooms) if self.blanks else None
+			generate(self.generator, blank or tasks, self.existing, self.finished, self.verbose)
+			tasks.flush()
+			if self.records is not None:
+				self.records.put(('generated',))
+			lines = self.summary() if self.summary else []
+			if blank and self.verbose:
+				lines.append(blank.summary())
+			self.lines.put(lines)
+		finally:
+			for i in range(self.stop):
+				self.queue.put(None)
+
+	def wait(self):
+		# Summary lines, None when the generator failed
+		lines = None
+		while lines is None:
+			try:
+				lines = self.lines.get(timeout=1)
+			except Queue.Empty:
+				if not self.is_alive():
+					break
+		self.join()
+		return lines
+
+def run_metrics(verbose, metrics_file, prometheus):
+	if verbose or metrics_file or prometheus:
+		return RunMetrics(verbose, metrics_file, prometheus)
+	return None
+
+def render_tiles_multithreaded(generator, mapfile, writer, num_threads=2, verbose=True, scale=1.0, renderlist=False, existing=None, finished=None, io_threads=0, feedback=None, metrics_file=None, prometheus=None, batch=TASK_BATCH, queue_depth=TASK_QUEUE_DEPTH, summary=None, skip_blank=False, blank_zooms=None, deep_layers=None):
 	if verbose:
 		print "render_tiles_multithreaded(",generator, mapfile, writer, num_threads, ")"
-	printLock = multiprocessing.Lock()
-	queue = multiprocessing.JoinableQueue(32)
+	queue = multiprocessing.JoinableQueue(queue_depth)
+	metrics = run_metrics(verbose, metrics_file, prometheus)
+	blanks = multiprocessing.Queue() if skip_blank else None
 	renderers = {}
 	for i in range(num_threads):
-		renderer = RenderThread(writer, mapfile, queue, printLock, verbose=verbose, scale=scale, renderlist=renderlist)
+		renderer = RenderThread(writer, mapfile, queue, scale=scale, renderlist=renderlist, io_threads=io_threads, feedback=feedback, metrics=metrics.records if metrics else None, worker=i, blanks=blanks, blank_zooms=blank_zooms, deep_layers=deep_layers)
 		render_thread = multiprocessing.Process(target=renderer.loop)
 		render_thread.start()
 		renderers[i] = render_thread
 
-	generator.generate(queue)
+	producer = TaskProducer(generator, queue, batch, existing, finished, verbose, records=metrics.records if metrics else None, summary=summary, blanks=blanks, blank_zooms=blank_zooms)
+	producer.start()
+	lines = producer.wait()
+	if lines is None:
+		print "Generating metatiles failed."
+		lines = []
 
 	# Signal render threads to exit by sending empty request to queue
 	for i in range(num_threads):
@@ -487,33 +2483,230 @@ def render_tiles_multithreaded(generator, mapfile, writer, num_threads=2, verbos
 	queue.join()
 	for i in range(num_threads):
 		renderers[i].join()
+	if metrics:
+		metrics.close()
+	for line in lines:
+		print line
 
-def render_tiles(generator, mapfile, writer, num_threads=1, verbose=True, scale=1.0, renderlist=False):
+def render_tiles(generator, mapfile, writer, num_threads=1, verbose=True, scale=1.0, renderlist=False, existing=None, finished=None, io_threads=0, feedback=None, metrics_file=None, prometheus=None, batch=TASK_BATCH, queue_depth=TASK_QUEUE_DEPTH, summary=None, skip_blank=False, blank_zooms=None, deep_layers=None):
 	if verbose:
 		print "render_tiles(",generator, mapfile, writer, ")"
 
-	printLock = multiprocessing.Lock()
-	queue = multiprocessing.JoinableQueue(0)
-	generator.generate(queue)
-	renderer = RenderThread(writer, mapfile, queue, printLock, verbose=verbose, scale=scale, renderlist=renderlist)
-	queue.put(None)
+	# The writer stays in this process, which renders what the generator
+	# process queues until it puts the end
+	queue = multiprocessing.JoinableQueue(queue_depth)
+	metrics = run_metrics(verbose, metrics_file, prometheus)
+	blanks = multiprocessing.Queue() if skip_blank else None
+	producer = TaskProducer(generator, queue, batch, existing, finished, verbose, records=metrics.records if metrics else None, summary=summary, stop=1, blanks=blanks, blank_zooms=blank_zooms)
+	producer.start()
+	renderer = RenderThread(writer, mapfile, queue, scale=scale, renderlist=renderlist, io_threads=io_threads, feedback=feedback, metrics=metrics.records if metrics else None, blanks=blanks, blank_zooms=blank_zooms, deep_layers=deep_layers)
 	renderer.loop()
+	lines = producer.wait()
+	if lines is None:
+		print "Generating metatiles failed."
+		lines = []
+	if metrics:
+		metrics.close()
+	for line in lines:
+		print line
+
+
+class ServiceJob:
+	# A job of the render service and the client connection that submitted it
+	def __init__(self, id, conn, journal):
+		self.id = id
+		self.conn = conn
+		self.journal = journal
+		self.lock = threading.Lock()
+		self.queued = 0
+		self.done = 0
+		self.tiles = 0
+		self.generated = False
+		self.finished = False
+		self.error = None
+		self.start = time.time()
+		self.reported = self.start
+
+	def send(self, line):
+		# The job goes on when its client has gone away
+		try:
+			self.conn.sendall(line + '\n')
+		except socket.error:
+			pass
 
+	def progress(self):
+		seconds = max(time.time() - self.start, 0.001)
+		return "{0}/{1}{2} metatiles, {3} tiles, {4:.1f} tiles/s".format(self.done, self.queued, '' if self.generated else '+', self.tiles, self.tiles / seconds)
+
+class JobQueue:
+	# Puts the tasks of one job into the shared render queue, in batches
+	def __init__(self, queue, job, params, batch=TASK_BATCH):
+		self.tasks = TaskBatcher(queue, batch)
+		self.job = job
+		self.params = params
+
+	def put(self, task):
+		task.job = (self.job.id, self.params)
+		with self.job.lock:
+			self.job.queued += 1
+		self.tasks.put(task)
+
+	def flush(self):
+		self.tasks.flush()
+
+class RenderService:
+	# Keeps render processes with a loaded map and takes jobs from clients over
+	# a UNIX socket; the tasks of all jobs go through the same processes
+	def __init__(self, path, mapfile, num_threads=2, scale=1.0, io_threads=0, batch=TASK_BATCH, queue_depth=TASK_QUEUE_DEPTH):
+		self.path = path
+		self.batch = batch
+		self.queue = multiprocessing.JoinableQueue(queue_depth)
+		self.results = multiprocessing.Queue()
+		self.jobs = {}
+		self.next_id = 0
+		self.lock = threading.Lock()
+		self.renderers = []
+		for i in range(num_threads):
+			renderer = RenderThread(None, mapfile, self.queue, scale=scale, io_threads=io_threads, results=self.results, worker=i)
+			render_thread = multiprocessing.Process(target=renderer.loop)
+			render_thread.daemon = True
+			render_thread.start()
+			self.renderers.append(render_thread)
+
+	def serve(self):
+		collector = threading.Thread(target=self.collect)
+		collector.daemon = True
+		collector.start()
+		if os.path.exists(self.path):
+			os.remove(self.path)
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(self.path)
+		server.listen(8)
+		# Stop like on Ctrl-C, which also ends the render processes
+		signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+		print "Waiting for jobs on {0}".format(self.path)
+		try:
+			while True:
+				(conn, addr) = server.accept()
+				client = threading.Thread(target=self.run_job, args=(conn,))
+				client.daemon = True
+				client.start()
+		finally:
+			server.close()
+			os.remove(self.path)
+
+	def run_job(self, conn):
+		line = conn.makefile('r').readline()
+		try:
+			spec = json.loads(line)
+			params = {'tile_dir': spec['tiledir'], 'format': spec['format'], 'tms': spec['tms'], 'overwrite': not spec['skip_existing'] or spec['resume'], 'deleteempty': spec['delete_empty']}
+			writer = FileWriter(journal=False, **params)
+			journal = Journal(writer.tile_dir[:-1] + '.journal', spec['resume'] or spec['skip_existing'])
+			existing = writer.existing_tiles() if spec['skip_existing'] and not spec['resume'] else None
+			if spec.get('list'):
+				generator = ListGenerator(open(spec['list']), metatile=spec['meta'], order=spec['order'])
+			else:
+				generator = PolyGenerator(wkt.loads(spec['poly']), spec['zooms'], metatile=spec['meta'], order=spec['order'], interleave=True, exact=spec['exact_area'])
+		except Exception, e:
+			conn.sendall("Error: {0}\n".format(e))
+			conn.close()
+			return
+
+		with self.lock:
+			self.next_id += 1
+			job = ServiceJob(self.next_id, conn, journal)
+			self.jobs[job.id] = job
+		print "Job {0}: {1} to {2}".format(job.id, generator, writer)
+		job.send("Job {0}: {1} to {2}".format(job.id, generator, writer))
+		tasks = JobQueue(self.queue, job, params, self.batch)
+		try:
+			generate(generator, tasks, existing, journal.finished, False)
+		except Exception, e:
+			# The metatiles queued so far are still rendered before the client
+			# gets the error
+			job.error = "Error: {0}".format(e)
+		tasks.flush()
+		with job.lock:
+			job.generated = True
+		self.check(job)
+
+	def check(self, job):
+		# Ends a job once all of its metatiles are queued and rendered
+		# Both the job's client thread and the collector may get here for the
+		# last metatile, only the first one ends it
+		with job.lock:
+			if job.finished or not job.generated or job.done < job.queued:
+				return
+			job.finished = True
+			job.journal.close()
+			if job.error:
+				job.send(job.progress())
+			job.send(job.error or "Done: " + job.progress())
+			job.conn.close()
+		with self.lock:
+			self.jobs.pop(job.id, None)
+		print "Job {0} {1}: {2}".format(job.id, 'failed' if job.error else 'done', job.error or job.progress())
+
+	def collect(self):
+		while True:
+			(id, z, x, y, metatile, tiles) = self.results.get()
+			job = self.jobs.get(id)
+			if not job:
+				continue
+			with job.lock:
+				if job.journal.record(z, x, y, metatile):
+					job.journal.sync()
+				job.done += 1
+				job.tiles += tiles
+				if time.time() - job.reported >= 1:
+					job.reported = time.time()
+					job.send(job.progress())
+			self.check(job)
+
+def submit_job(path, spec):
+	# Sends a job to a render service and prints its progress until it is done
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.connect(path)
+	client.sendall(json.dumps(spec) + '\n')
+	ok = True
+	for line in client.makefile('r'):
+		print line.rstrip('\n')
+		sys.stdout.flush()
+		ok = not line.startswith('Error')
+	client.close()
+	return ok
+
+
+def meta_size(value):
+	# Zero stands for automatic metatile sizes
+	return 0 if value == 'auto' else int(value)
 
 def poly_parse(fp):
+	# Rings are applied in file order like osmosis does, so an island inside a
+	# lake stays; consecutive rings of the same kind are merged in one union
 	result = None
+	run = []
+	run_hole = False
 	poly = []
 	data = False
+
+	def apply(result, run, hole):
+		if not run:
+			return result
+		rings = unary_union(run) if len(run) > 1 else run[0]
+		if hole:
+			return result.difference(rings) if result else result
+		return result.union(rings) if result else rings
+
 	for l in fp:
 		l = l.strip()
 		if l == 'END' and data:
 			if len(poly) > 0:
-				if hole and result:
-					result = result.difference(Polygon(poly))
-				elif not hole and result:
-					result = result.union(Polygon(poly))
-				elif not hole:
-					result = Polygon(poly)
+				if hole != run_hole:
+					result = apply(result, run, run_hole)
+					run = []
+					run_hole = hole
+				run.append(Polygon(poly))
 			poly = []
 			data = False
 		elif l == 'END' and not data:
@@ -523,7 +2716,7 @@ def poly_parse(fp):
 			hole = l[0] == '!'
 		elif l and data:
 			poly.append(map(lambda x: float(x.strip()), l.split()[:2]))
-	return result
+	return apply(result, run, run_hole)
 
 
 def read_db(db, osm_id=0):
@@ -570,7 +2763,9 @@ if __name__ == "__main__":
 	if HAS_PSYCOPG:
 		apg_input.add_argument("-a", "--area", type=int, metavar='OSM_ID', help="generate tiles inside an OSM polygon: positive for polygons, negative for relations, 0 for whole database")
 		apg_input.add_argument("-c", "--cities", type=int, metavar='OSM_ID', help='generate tiles for all towns inside a polygon')
-	apg_input.add_argument('-l', '--list', type=argparse.FileType('r'), metavar='TILES.LST', help='process tile list')
+	apg_input.add_argument('-l', '--list', type=argparse.FileType('r'), metavar='TILES.LST', help='process tile list, text or binary')
+	apg_input.add_argument('--merge', nargs='+', metavar='SHARD', help='copy the tiles of --shard runs, tile directories or MBTiles files, into the output')
+	apg_input.add_argument('--optimize', nargs='+', metavar='TILES', help='recompress the tiles of tile directories or MBTiles files in place, losslessly and on --threads processes')
 	apg_output = parser.add_argument_group('Output')
 	apg_output.add_argument('-t', '--tiledir', metavar='DIR', help='output tiles to directory (default: {0}/tiles)'.format(os.getcwd()))
 	apg_output.add_argument('--tms', action='store_true', help='write files in TMS order', default=False)
@@ -578,19 +2773,42 @@ if __name__ == "__main__":
 		apg_output.add_argument('-m', '--mbtiles', help='generate mbtiles file')
 		apg_output.add_argument('--name', help='name for mbtiles', default='Test MBTiles')
 		apg_output.add_argument('--overlay', action='store_true', help='if this layer is an overlay (for mbtiles metadata)', default=False)
-	apg_output.add_argument('-x', '--export', type=argparse.FileType('w'), metavar='TILES.LST', help='save tile list into file')
+		apg_output.add_argument('--dedup', action='store_true', help='store identical tiles only once (map/images layout for new mbtiles)', default=False)
+		apg_output.add_argument('--batch', type=int, metavar='N', help='commit mbtiles every N tiles with one executemany, journaling the metatiles finished so far, and index new files at the end (default: 0, commit with every journal sync)', default=0)
+		apg_output.add_argument('--wal', action='store_true', help='use write-ahead logging for mbtiles', default=False)
+	apg_output.add_argument('-x', '--export', type=argparse.FileType('w'), metavar='TILES.LST', help='save tile list into file, binary when named *.bin')
 	apg_output.add_argument('-z', '--zooms', type=int, nargs=2, metavar=('ZMIN', 'ZMAX'), help='range of zoom levels to render (default: 0 11)', default=(0, 11))
+	apg_output.add_argument('--zoom-list', type=int, nargs='+', metavar='Z', help='zoom levels to render instead of a range, e.g. 11 13 15 17')
 	apg_other = parser.add_argument_group('Settings')
 	apg_other.add_argument('-s', '--style', help='style file for mapnik (default: {0})'.format(mapfile), default=mapfile)
 	apg_other.add_argument('-f', '--format', default='png256', help='tile image format (default: png256)')
-	apg_other.add_argument('--meta', type=int, default=8, metavar='N', help='metatile size NxN tiles (default: 8)')
+	apg_other.add_argument('--meta', type=meta_size, default=8, metavar='N', help='metatile size NxN tiles, or "auto" to choose per zoom and region (default: 8)')
+	apg_other.add_argument('--meta-sizes', type=int, nargs='+', default=[2, 4, 8, 16], metavar='N', help='metatile sizes for --meta auto, powers of two (default: 2 4 8 16)')
+	apg_other.add_argument('--meta-target', type=float, default=10.0, metavar='SEC', help='split metatiles that take longer to render with --meta auto (default: 10)')
+	apg_other.add_argument('--meta-memory', type=int, default=2048, metavar='MB', help='use smaller metatiles when a render process grows beyond this with --meta auto (default: 2048)')
+	apg_other.add_argument('--exact-area', action='store_true', default=False, help='test tiles against the full resolution area instead of one simplified per zoom')
+	apg_other.add_argument('--order', choices=['column'] + sorted(ORDERS), default='column', help='order of metatiles within a zoom level, hilbert and zorder keep neighbours together (default: column)')
+	apg_other.add_argument('--shard', type=shard_spec, metavar='I/N', help='render only part I of N of the metatiles, a contiguous part of every zoom level')
 	apg_other.add_argument('--scale', type=float, default=1.0, help='scale factor for HiDpi tiles (affects tile size)')
 	apg_other.add_argument('--threads', type=int, metavar='N', help='number of threads (default: 2)', default=4)
-	apg_other.add_argument('--skip-existing', action='store_true', default=False, help='do not overwrite existing files')
-	apg_other.add_argument('--delete-empty', action='store_true', default=False, help='delete empty tiles')
+	apg_other.add_argument('--io-threads', type=int, metavar='N', help='threads per render process that encode and write tiles while the next metatile renders, 0 to write in between (default: 2)', default=2)
+	apg_other.add_argument('--skip-blank', action='store_true', default=False, help='fill the tiles under tiles of a higher zoom level of the run that came out in a single color with that color instead of rendering them; zoom levels are then rendered one after another')
+	apg_other.add_argument('--deep-layers', nargs='*', metavar='LAYER', default=DEEP_LAYERS, help='layers that may appear only at higher zoom levels: a blank tile stands for the tiles under it only when these have no features in it (default: the layers of mazda.xml with rules beyond the scale of z11)')
+	apg_other.add_argument('--task-batch', type=int, metavar='N', help='metatiles per batch on the render queue (default: {0})'.format(TASK_BATCH), default=TASK_BATCH)
+	apg_other.add_argument('--queue-depth', type=int, metavar='N', help='batches the generator process keeps ahead of the render processes (default: {0})'.format(TASK_QUEUE_DEPTH), default=TASK_QUEUE_DEPTH)
+	apg_other.add_argument('--skip-existing', action='store_true', default=False, help='do not render tiles that already exist, nor metatiles in the journal of an interrupted run')
+	apg_other.add_argument('--resume', action='store_true', default=False, help='continue an interrupted run from its journal')
+	apg_other.add_argument('--delete-empty', action='store_true', default=False, help='do not write empty (single colored) tiles')
 	apg_other.add_argument('--custom-fonts', dest='customfonts', help='include custom fonts from a directory',  default=False)
 	apg_other.add_argument('--for-renderd', action='store_true', default=False, help='produce only a single tile for metatiles')
+	apg_other.add_argument('--metrics', metavar='FILE', help='write a JSON line with the timings of every metatile and per zoom totals')
+	apg_other.add_argument('--prometheus', metavar='FILE', help='keep run metrics in a Prometheus textfile')
+	apg_other.add_argument('--webp', nargs='?', const='webp:lossless=1', metavar='FORMAT', help='with --optimize, convert the tiles to WebP with mapnik (default format: webp:lossless=1)')
+	apg_other.add_argument('--estimate', type=int, metavar='N', help='do not write tiles, count them per zoom and render N random metatiles of every zoom to estimate time and size of the run')
 	apg_other.add_argument('-q', '--quiet', dest='verbose', action='store_false', help='do not print any information',  default=True)
+	apg_service = parser.add_argument_group('Render service')
+	apg_service.add_argument('--serve', metavar='SOCKET', help='keep render processes with the loaded style running and take jobs on a UNIX socket')
+	apg_service.add_argument('--submit', metavar='SOCKET', help='let a render service render this job into a tile directory and show its progress')
 	if HAS_PSYCOPG:
 		apg_db = parser.add_argument_group('Database (for poly/cities)')
 		apg_db.add_argument('-d', '--dbname', metavar='DB', help='database (default: gis)', default='gis')
@@ -601,25 +2819,76 @@ if __name__ == "__main__":
 	options = parser.parse_args()
 
 	# check for required argument
-	if options.bbox == None and options.poly == None and (not HAS_PSYCOPG or (options.cities == None and options.area == None)) and options.list == None:
+	if options.bbox == None and options.poly == None and (not HAS_PSYCOPG or (options.cities == None and options.area == None)) and options.list == None and not options.serve and not options.merge and not options.optimize:
 		parser.print_help()
 		sys.exit()
 
 	# custom fonts
-	if(options.customfonts):
+	if(options.customfonts and HAS_MAPNIK):
 		from mapnik import register_fonts, FontEngine
  		#custom_fonts_dir = '../../../fonts/'
 		register_fonts(options.customfonts);
 
-	# writer
-	if options.tiledir:
-		writer = FileWriter(options.tiledir, format=options.format, tms=options.tms, overwrite=not options.skip_existing, deleteempty= options.delete_empty)
+	if options.serve:
+		if not HAS_MAPNIK:
+			print "Mapnik is required for rendering tiles."
+			sys.exit(1)
+		RenderService(options.serve, options.style, num_threads=options.threads, scale=options.scale, io_threads=options.io_threads, batch=options.task_batch, queue_depth=options.queue_depth).serve()
+		sys.exit()
+
+	if options.optimize:
+		if options.webp and not HAS_MAPNIK:
+			print "Mapnik is required for converting tiles to WebP."
+			sys.exit(1)
+		if not options.webp and not png_optimizer():
+			print "Neither oxipng nor optipng was found, PNG tiles are left as they are."
+		for source in options.optimize:
+			if os.path.isfile(source) and not HAS_SQLITE:
+				print "SQLite is required for optimizing MBTiles files."
+				sys.exit(1)
+			optimizer = TileOptimizer(source, webp=options.webp, format=options.format)
+			optimizer.run(options.threads)
+			if options.verbose:
+				print "Optimized {0}".format(source)
+				for line in optimizer.summary():
+					print line
+		sys.exit()
+
+	# all shards are checked before anything gets written
+	for source in options.merge or []:
+		if not os.path.isfile(source) and not os.path.isdir(source):
+			print "Shard not found: {0}".format(source)
+			sys.exit(1)
+		if os.path.isfile(source) and not HAS_SQLITE:
+			print "SQLite is required for merging MBTiles files."
+			sys.exit(1)
+
+	# writer; --skip-existing also keeps the journal of an interrupted run,
+	# since --delete-empty leaves no trace of the empty tiles of a metatile
+	keep_journal = options.resume or options.skip_existing
+	if options.submit or options.estimate is not None:
+		# the render service writes the tiles, estimates write nothing
+		writer = None
+	elif options.tiledir:
+		writer = FileWriter(options.tiledir, format=options.format, tms=options.tms, overwrite=not options.skip_existing or options.resume, deleteempty= options.delete_empty, resume=keep_journal)
 	elif HAS_SQLITE and options.mbtiles:
-		writer = multi_MBTilesWriter(options.threads, options.mbtiles, options.name, overlay=options.overlay, format=options.format)
+		writer = multi_MBTilesWriter(options.threads, options.mbtiles, options.name, overlay=options.overlay, format=options.format, deleteempty=options.delete_empty, dedup=options.dedup, batch=options.batch, wal=options.wal, resume=keep_journal)
 	elif options.export:
-		writer = ListWriter(options.export)
+		writer = list_writer(options.export)
 	else:
-		writer = FileWriter(os.getcwd() + '/tiles', format=options.format, tms=options.tms, overwrite=not options.skip_existing)
+		writer = FileWriter(os.getcwd() + '/tiles', format=options.format, tms=options.tms, overwrite=not options.skip_existing or options.resume, resume=keep_journal)
+
+	if options.merge:
+		if not writer or not writer.need_image():
+			print "Shards are merged into a tile directory or an MBTiles file."
+			sys.exit(1)
+		merge_shards(options.merge, writer, format=options.format, tms=options.tms, verbose=options.verbose)
+		writer.close()
+		sys.exit()
+
+	if ((writer and writer.need_image()) or options.estimate) and not HAS_MAPNIK:
+		print "Mapnik is required for rendering tiles."
+		sys.exit(1)
 
 	# input and process
 	poly = None
@@ -647,17 +2916,79 @@ if __name__ == "__main__":
 			print "Error connecting to database: ", e.pgerror or e
 			sys.exit(1)
 
+	sizer = None
+	if options.meta == 0:
+		if [m for m in options.meta_sizes if m < 1 or m & (m - 1)]:
+			print "Metatile sizes must be powers of two."
+			sys.exit(1)
+		sizer = MetatileSizer(options.meta_sizes, target=options.meta_target, memory=options.meta_memory, feedback=multiprocessing.Queue())
+
 	if options.list:
-		generator = ListGenerator(options.list, metatile=options.meta)
+		generator = ListGenerator(options.list, metatile=options.meta or 8, order=options.order)
 	elif poly:
-		generator = PolyGenerator(poly, range(options.zooms[0], options.zooms[1] + 1), metatile=options.meta)
+		zooms = options.zoom_list or range(options.zooms[0], options.zooms[1] + 1)
+		generator = PolyGenerator(poly, zooms, metatile=options.meta, sizer=sizer, order=options.order, interleave=not options.skip_blank, exact=options.exact_area)
 	else:
 		print "Please specify a region for rendering."
 		sys.exit()
+	shard = Shard(generator, options.shard[0], options.shard[1]) if options.shard else None
+	tasks = shard or generator
+
+	if options.submit:
+		if getattr(options, 'mbtiles', None) or options.export:
+			print "The render service only writes tile directories."
+			sys.exit(1)
+		if shard:
+			print "The render service does not take shards."
+			sys.exit(1)
+		spec = {
+			'tiledir': os.path.abspath(options.tiledir or os.getcwd() + '/tiles'),
+			'poly': poly.wkt if poly and not options.list else None,
+			'list': os.path.abspath(options.list.name) if options.list else None,
+			'zooms': options.zoom_list or range(options.zooms[0], options.zooms[1] + 1),
+			'format': options.format,
+			'tms': options.tms,
+			'meta': options.meta or 8,
+			'order': options.order,
+			'exact_area': options.exact_area,
+			'skip_existing': options.skip_existing,
+			'resume': options.resume,
+			'delete_empty': options.delete_empty,
+		}
+		sys.exit(0 if submit_job(options.submit, spec) else 1)
+
+	if options.estimate is not None:
+		estimator = Estimator(options.estimate)
+		tasks.generate(estimator)
+		estimator.render(options.style, scale=options.scale, format=options.format)
+		estimator.report(threads=options.threads, deleteempty=options.delete_empty)
+		sys.exit()
+
+	# tiles that are already there are not rendered again; when resuming, tiles
+	# of unfinished metatiles may be half-written and are always redone.
+	# Journaled metatiles are skipped as a whole either way.
+	existing = writer.existing_tiles() if options.skip_existing and not options.resume else None
+	finished = writer.finished()
+
+	# Blank tiles of the deepest zoom level are of no use, and only rendered
+	# tiles can be blank
+	blank_zooms = set(generator.zooms[:-1]) if isinstance(generator, PolyGenerator) else None
+	skip_blank = options.skip_blank and writer.need_image()
+
+	def summary():
+		# Printed at the end, made where the generator ran
+		lines = []
+		if options.verbose and options.list:
+			lines.append(generator.summary())
+		if options.verbose and shard:
+			lines.append(shard.summary())
+		if options.verbose and sizer:
+			lines.append("Metatile sizes: " + sizer.summary())
+		return lines
 
 	if options.threads > 1 and writer.multithreading():
-		render_tiles_multithreaded(generator, options.style, writer, num_threads=options.threads, verbose=options.verbose, scale=options.scale, renderlist=options.for_renderd)
+		render_tiles_multithreaded(tasks, options.style, writer, num_threads=options.threads, verbose=options.verbose, scale=options.scale, renderlist=options.for_renderd, existing=existing, finished=finished, io_threads=options.io_threads, feedback=sizer.feedback if sizer else None, metrics_file=options.metrics, prometheus=options.prometheus, batch=options.task_batch, queue_depth=options.queue_depth, summary=summary, skip_blank=skip_blank, blank_zooms=blank_zooms, deep_layers=options.deep_layers)
 	else:
-		render_tiles(generator, options.style, writer, verbose=options.verbose, scale=options.scale, renderlist=options.for_renderd)
+		render_tiles(tasks, options.style, writer, verbose=options.verbose, scale=options.scale, renderlist=options.for_renderd, existing=existing, finished=finished, io_threads=options.io_threads, feedback=sizer.feedback if sizer else None, metrics_file=options.metrics, prometheus=options.prometheus, batch=options.task_batch, queue_depth=options.queue_depth, summary=summary, skip_blank=skip_blank, blank_zooms=blank_zooms, deep_layers=options.deep_layers)
 
 	writer.close()
@@ -7,10 +7,7 @@
 
 cd ../../../base
 
-./polytiles.py -p ../poly/north-america/us/colorado.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-colorado/ --zooms 11 11 --delete-empty --custom-fonts ../../../fonts/
-./polytiles.py -p ../poly/north-america/us/colorado.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-colorado/ --zooms 13 13 --delete-empty --custom-fonts ../../../fonts/
-./polytiles.py -p ../poly/north-america/us/colorado.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-colorado/ --zooms 15 15 --delete-empty --custom-fonts ../../../fonts/
-./polytiles.py -p ../poly/north-america/us/colorado.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-colorado/ --zooms 17 17 --delete-empty --custom-fonts ../../../fonts/
+./polytiles.py -p ../poly/north-america/us/colorado.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-colorado/ --zoom-list 11 13 15 17 --delete-empty --custom-fonts ../../../fonts/
 
 # cleanup
 echo "[Cleanup] This may take a while so hold tight."
@@ -7,10 +7,7 @@
 
 cd ../../../base
 
-./polytiles.py -p ../poly/north-america/us/louisiana.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-louisiana/ --zooms 11 11 --delete-empty --custom-fonts ../../../fonts/
-./polytiles.py -p ../poly/north-america/us/louisiana.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-louisiana/ --zooms 13 13 --delete-empty --custom-fonts ../../../fonts/
-./polytiles.py -p ../poly/north-america/us/louisiana.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-louisiana/ --zooms 15 15 --delete-empty --custom-fonts ../../../fonts/
-./polytiles.py -p ../poly/north-america/us/louisiana.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-louisiana/ --zooms 17 17 --delete-empty --custom-fonts ../../../fonts/
+./polytiles.py -p ../poly/north-america/us/louisiana.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-louisiana/ --zoom-list 11 13 15 17 --delete-empty --custom-fonts ../../../fonts/
 
 # cleanup
 echo "[Cleanup] This may take a while so hold tight."
@@ -7,10 +7,7 @@
 
 cd ../../../base
 
-./polytiles.py -p ../poly/north-america/us/michigan.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-michigan/ --zooms 11 11 --delete-empty --custom-fonts ../../../fonts/
-./polytiles.py -p ../poly/north-america/us/michigan.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-michigan/ --zooms 13 13 --delete-empty --custom-fonts ../../../fonts/
-./polytiles.py -p ../poly/north-america/us/michigan.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-michigan/ --zooms 15 15 --delete-empty --custom-fonts ../../../fonts/
-./polytiles.py -p ../poly/north-america/us/michigan.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-michigan/ --zooms 17 17 --delete-empty --custom-fonts ../../../fonts/
+./polytiles.py -p ../poly/north-america/us/michigan.poly -s ../../tilestyles/mazda/mazda.xml -t ../../../output/north-america-us-michigan/ --zoom-list 11 13 15 17 --delete-empty --custom-fonts ../../../fonts/
 
 # cleanup
 echo "[Cleanup] This may take a while so hold tight."